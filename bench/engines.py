@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+
+# Run each benchmark program under both engines and check that the
+# bytecode engine behaves the same as the tree walker.
+#
+#   bench/engines.py [--python PYTHON] [--memory-ratio RATIO] [NAME...]
+#
+# The output of the two runs must be identical, and the bytecode run's
+# peak memory may be at most RATIO times the tree walker's, which
+# catches a lost tail call (see tail.scm) as well as a wrong answer.
+# The exit status is 1 if any program differs.
+
+import argparse
+import sys
+
+from run import benchmarks, generate_data, prepare_run, run_once
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the tree and bytecode engines.')
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help='programs to run (default: all)')
+    parser.add_argument('--python', default=sys.executable,
+                        help='Python interpreter to run scheme.py with')
+    parser.add_argument('--memory-ratio', type=float, default=1.5,
+                        help='most peak memory bytecode may use, relative '
+                        'to the tree walker')
+    args = parser.parse_args()
+
+    generate_data()
+    failed = False
+    print('%-16s %9s %9s  %s' % ('program', 'tree MB', 'bytecode', 'result'))
+    for name, program, expected in benchmarks:
+        if not program or args.names and name not in args.names:
+            continue
+        command = [args.python, 'scheme.py']
+        prepare_run(name, command)
+        tree = run_once(command, program)
+        prepare_run(name, command)
+        bytecode = run_once(command + ['--bytecode'], program)
+        elapsed, tree_rss, tree_status, tree_output = tree
+        elapsed, bytecode_rss, bytecode_status, bytecode_output = bytecode
+        if (tree_status, tree_output) != (bytecode_status, bytecode_output):
+            result = 'output differs'
+        elif bytecode_rss > tree_rss * args.memory_ratio:
+            result = 'bytecode uses more memory'
+        else:
+            result = 'same'
+        failed = failed or result != 'same'
+        print('%-16s %9.1f %9.1f  %s' % (name, tree_rss / 1024.0,
+                                         bytecode_rss / 1024.0, result))
+        sys.stdout.flush()
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
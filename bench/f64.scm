@@ -0,0 +1,20 @@
+;;; Aggregate 100000 samples held in an f64vector: scale them, then
+;;; take their mean and sum of squares, 20 times over.
+
+(define samples
+  (f64vector-map (lambda (i) (* i 0.5))
+                 (list->f64vector
+                  (let loop ((i 0) (lst '()))
+                    (if (= i 100000) lst (loop (+ i 1) (cons i lst)))))))
+
+(define (aggregate n)
+  (let loop ((i 0) (total 0.))
+    (if (= i n)
+        (round total)
+        (let ((scaled (f64vector* samples 1.5)))
+          (loop (+ i 1)
+                (+ total
+                   (/ (f64vector-sum scaled) (f64vector-length scaled))
+                   (/ (f64vector-dot scaled scaled) 1e9)))))))
+
+(aggregate 20)
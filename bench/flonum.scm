@@ -0,0 +1,22 @@
+;;; Count the points of a 32x32 grid in the Mandelbrot set, in floats.
+
+(define (escapes? cr ci limit)
+  (let loop ((zr 0.) (zi 0.) (i 0))
+    (cond ((= i limit) #f)
+          ((> (+ (* zr zr) (* zi zi)) 4.) #t)
+          (else (loop (+ (- (* zr zr) (* zi zi)) cr)
+                      (+ (* 2. zr zi) ci)
+                      (+ i 1))))))
+
+(define (mandelbrot n limit)
+  (let loop ((x 0) (y 0) (count 0))
+    (cond ((= y n) count)
+          ((= x n) (loop 0 (+ y 1) count))
+          (else
+           (loop (+ x 1) y
+                 (if (escapes? (- (* 3. (/ x n)) 2.) (- (* 3. (/ y n)) 1.5)
+                               limit)
+                     count
+                     (+ count 1)))))))
+
+(mandelbrot 32 50)
@@ -0,0 +1,21 @@
+;;; Build, transform and combine long lists with map, append and
+;;; reverse.
+
+(define (iota n)
+  (let loop ((i (- n 1)) (acc '()))
+    (if (< i 0) acc (loop (- i 1) (cons i acc)))))
+
+(define (sum lst)
+  (let loop ((lst lst) (acc 0))
+    (if (null? lst) acc (loop (cdr lst) (+ acc (car lst))))))
+
+(define (churn n)
+  (let loop ((i 0) (total 0))
+    (if (= i n)
+        total
+        (let* ((a (iota 2000))
+               (b (map (lambda (x) (* x 2)) a))
+               (c (append a (reverse b))))
+          (loop (+ i 1) (+ total (sum c) (length (map + a b))))))))
+
+(churn 20)
@@ -0,0 +1,4 @@
+;;; Load a generated library of definitions and call a sample of them.
+
+(load "bench/data/library.scm")
+(library-check)
@@ -0,0 +1,12 @@
+;;; Count primes by trial division in do and named let loops.
+
+(define (count-primes n)
+  (do ((i 2 (+ i 1))
+       (count 0 (if (prime? i) (+ count 1) count)))
+      ((> i n) count)))
+(define (prime? n)
+  (let loop ((d 2))
+    (cond ((> (* d d) n) #t)
+          ((= (remainder n d) 0) #f)
+          (else (loop (+ d 1))))))
+(count-primes 10000)
@@ -0,0 +1,21 @@
+;;; Count the solutions to the eight queens problem.
+
+(define (ok? row dist placed)
+  (or (null? placed)
+      (and (not (= (car placed) (+ row dist)))
+           (not (= (car placed) (- row dist)))
+           (not (= (car placed) row))
+           (ok? row (+ dist 1) (cdr placed)))))
+
+(define (try-rows row n placed)
+  (if (> row n)
+      0
+      (+ (if (ok? row 1 placed) (queens n (cons row placed)) 0)
+         (try-rows (+ row 1) n placed))))
+
+(define (queens n placed)
+  (if (= (length placed) n)
+      1
+      (try-rows 1 n placed)))
+
+(queens 8 '())
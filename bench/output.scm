@@ -0,0 +1,12 @@
+;;; Write many small records to a file, a few objects at a time.
+
+(define (dump n)
+  (let ((port (open-output-file "/dev/null")))
+    (do ((i 0 (+ i 1)))
+        ((= i n) (close-output-port port) 'done)
+      (write i port)
+      (write-char #\space port)
+      (write (list 'record i "name") port)
+      (write-char #\newline port))))
+
+(dump 50000)
@@ -0,0 +1,4 @@
+;;; Read a large generated data file.  The harness writes
+;;; bench/data/reader-data.scm before running this.
+
+(length (read-all "bench/data/reader-data.scm"))
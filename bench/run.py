@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+# Run the benchmarks against scheme.py and report the best time and
+# peak memory of each.
+#
+#   bench/run.py [-n RUNS] [--bytecode] [-o results.json]
+#                [-b baseline.json] [--threshold FRACTION] [NAME...]
+#
+# Each benchmark is a Scheme program fed to the interpreter's standard
+# input from the repository root, and must print its expected result.
+# With -o, the results are saved as JSON; with -b, they are compared
+# with results saved earlier, and the exit status is 1 if any
+# benchmark got slower by more than the threshold (or failed).  To see
+# what a newer Python buys, save results with one interpreter and
+# compare another against them:
+#
+#   bench/run.py --python python3.8 -o py38.json
+#   bench/run.py --python python3.12 -b py38.json
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(bench_dir)
+
+# name, program, value it prints last
+benchmarks = [
+    ('startup',         None,                   None),
+    ('load-cold',       'load.scm',             '1010062'),
+    ('load-cached',     'load.scm',             '1010062'),
+    ('reader',          'reader.scm',           '20000'),
+    ('fib',             'fib.scm',              '75025'),
+    ('tak',             'tak.scm',              '7'),
+    ('nqueens',         'nqueens.scm',          '92'),
+    ('lists',           'lists.scm',            '119980000'),
+    ('strings',         'strings.scm',          '199990000'),
+    ('text',            'text.scm',             '4000'),
+    ('output',          'output.scm',           'done'),
+    ('loop',            'loop.scm',             '1229'),
+    ('flonum',          'flonum.scm',           '185'),
+    ('f64',             'f64.scm',              '4499936.0'),
+    ('vectors',         'vectors.scm',          '3245'),
+    ('tables',          'tables.scm',           '500'),
+    ('search-return',   'search-return.scm',    'done'),
+    ('search-escape',   'search-escape.scm',    'done'),
+    ('tail',            'tail.scm',             'done'),
+    ]
+
+reader_data = os.path.join(bench_dir, 'data', 'reader-data.scm')
+
+def generate_reader_data():
+    # 20000 top-level forms mixing lists, symbols, numbers, strings and
+    # characters.  The generator is seeded, so the file never changes.
+    if os.path.exists(reader_data):
+        return
+    if not os.path.isdir(os.path.dirname(reader_data)):
+        os.makedirs(os.path.dirname(reader_data))
+    rng = random.Random(17)
+    def datum(depth):
+        kind = rng.randrange(6 if depth < 4 else 4)
+        if kind == 0:
+            return str(rng.randrange(-100000, 100000))
+        elif kind == 1:
+            return rng.choice(['foo', 'bar-baz', 'list->vector', 'x', '+'])
+        elif kind == 2:
+            return '"string %d\\n"' % rng.randrange(1000)
+        elif kind == 3:
+            return rng.choice(['#\\a', '#\\space', '#t', '#f'])
+        return '(%s)' % ' '.join(datum(depth + 1)
+                                 for i in range(rng.randrange(1, 6)))
+    with open(reader_data, 'w') as f:
+        for i in range(20000):
+            f.write("(define item-%d '%s)\n" % (i, datum(0)))
+
+library = os.path.join(bench_dir, 'data', 'library.scm')
+
+def generate_library():
+    # 4000 procedure and data definitions in the shapes real programs
+    # use, for load.scm to load, ending with library-check, which calls
+    # a sample of them.  Seeded like the reader data.
+    if os.path.exists(library):
+        return
+    if not os.path.isdir(os.path.dirname(library)):
+        os.makedirs(os.path.dirname(library))
+    rng = random.Random(23)
+    simple = []
+    forms = []
+    for i in range(4000):
+        k = rng.randrange(1, 50)
+        kind = rng.randrange(7 if simple else 6)
+        if kind == 0:
+            forms.append('(define (f%d x)\n  (+ x %d))' % (i, k))
+        elif kind == 1:
+            forms.append('(define (f%d x)\n  (if (> x %d) (- x %d) (* x 2)))'
+                         % (i, k, k))
+        elif kind == 2:
+            forms.append('(define (f%d x)\n'
+                         '  (let loop ((n %d) (acc x))\n'
+                         '    (if (= n 0) acc (loop (- n 1) (+ acc 1)))))'
+                         % (i, k))
+        elif kind == 3:
+            forms.append("(define table%d '((alpha . 1) (beta . %d) "
+                         "(gamma \"three\" #\\c)))\n"
+                         "(define (f%d x)\n"
+                         "  (+ x (cdr (assq 'beta table%d))))" % (i, k, i, i))
+        elif kind == 4:
+            forms.append('(define (f%d x)\n'
+                         '  (define (scale y) (* y %d))\n'
+                         '  (let* ((a (scale x)) (b (- a x)))\n'
+                         '    (+ b (string-length "text %d"))))'
+                         % (i, k, i))
+        elif kind == 5:
+            forms.append("(define (f%d x)\n"
+                         "  (case (remainder x 3)\n"
+                         "    ((0) (+ x (vector-ref '#(%d 2 3) 0)))\n"
+                         "    ((1) (apply + (list x %d)))\n"
+                         "    (else (length (list x 'a 'b)))))" % (i, k, k))
+        else:
+            forms.append('(define (f%d x)\n  (f%d (f%d x)))'
+                         % (i, rng.choice(simple), rng.choice(simple)))
+        if kind < 6:
+            simple.append(i)
+    forms.append('(define (library-check)\n  (+ %s))' %
+                 '\n     '.join('(f%d %d)' % (i, i)
+                                 for i in range(0, 4000, 40)))
+    with open(library, 'w') as f:
+        f.write(';;; Generated by bench/run.py for bench/load.scm.\n\n')
+        for form in forms:
+            f.write(form + '\n\n')
+
+def generate_data():
+    generate_reader_data()
+    generate_library()
+
+library_cache = library + 'c'
+
+def prepare_run(name, command):
+    # load writes a cache of the library's forms, so load-cold removes it
+    # before each run and load-cached makes sure it's there, so that
+    # every run of either takes the same path.
+    if name == 'load-cold':
+        if os.path.exists(library_cache):
+            os.remove(library_cache)
+    elif name == 'load-cached' and not os.path.exists(library_cache):
+        run_once(command, 'load.scm')
+
+def run_once(command, program):
+    stdin = open(os.path.join(bench_dir, program) if program else os.devnull)
+    start = time.time()
+    p = subprocess.Popen(command, cwd=root, stdin=stdin,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.stdout.read().decode('latin-1')
+    pid, status, usage = os.wait4(p.pid, 0)
+    elapsed = time.time() - start
+    p.returncode = status
+    stdin.close()
+    return elapsed, usage.ru_maxrss, status, output
+
+def python_version(python):
+    return subprocess.check_output(
+        [python, '-c', 'import platform; print(platform.python_version())'],
+        universal_newlines=True).strip()
+
+def run_benchmark(name, command, program, expected, runs):
+    times = []
+    maxrss = 0
+    for i in range(runs):
+        prepare_run(name, command)
+        elapsed, rss, status, output = run_once(command, program)
+        if status != 0 or (expected and '> %s\n' % expected not in output):
+            return {'error': output.strip().splitlines()[-1:]}
+        times.append(elapsed)
+        maxrss = max(maxrss, rss)
+    return {'time': min(times), 'times': times, 'maxrss_kb': maxrss}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark scheme.py.')
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('-n', '--runs', type=int, default=3,
+                        help='runs per benchmark; the best is reported')
+    parser.add_argument('--bytecode', action='store_true',
+                        help='run with the bytecode engine')
+    parser.add_argument('--python', default=sys.executable,
+                        help='Python interpreter to run scheme.py with')
+    parser.add_argument('-o', '--output', help='save results as JSON')
+    parser.add_argument('-b', '--baseline', help='compare with saved results')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='slowdown that counts as a regression')
+    args = parser.parse_args()
+
+    known = [name for name, program, expected in benchmarks]
+    for name in args.names:
+        if name not in known:
+            parser.error('unknown benchmark %s (choose from %s)' %
+                         (name, ', '.join(known)))
+    command = [args.python, 'scheme.py']
+    if args.bytecode:
+        command.append('--bytecode')
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['benchmarks']
+    generate_data()
+
+    results = {}
+    failed = False
+    print('%-16s %9s %9s %9s %8s' % ('benchmark', 'time s', 'max MB',
+                                     'base s', 'ratio'))
+    for name, program, expected in benchmarks:
+        if args.names and name not in args.names:
+            continue
+        result = results[name] = run_benchmark(name, command, program,
+                                               expected, args.runs)
+        if 'error' in result:
+            failed = True
+            print('%-16s FAILED %s' % (name, ' '.join(result['error'])))
+            continue
+        line = '%-16s %9.3f %9.1f' % (name, result['time'],
+                                      result['maxrss_kb'] / 1024.0)
+        base = baseline.get(name, {}).get('time')
+        if base:
+            ratio = result['time'] / base
+            line += ' %9.3f %8.2f' % (base, ratio)
+            if ratio > 1 + args.threshold:
+                failed = True
+                line += '  slower'
+        print(line)
+        sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': python_version(args.python),
+                       'engine': 'bytecode' if args.bytecode else 'tree',
+                       'runs': args.runs,
+                       'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'benchmarks': results},
+                      f, indent=2, sort_keys=True)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+;;; Search a big list many times, returning the match normally.
+;;; search-escape.scm does the same work but leaves the loop through
+;;; an escape continuation.
+
+(define (numbers n)
+  (define (iter i l)
+    (if (= i 0) l (iter (- i 1) (cons i l))))
+  (iter n '()))
+
+(define data (numbers 10000))
+
+(define (search x)
+  (define (loop l)
+    (if (null? l)
+        #f
+        (if (= (car l) x)
+            (car l)
+            (loop (cdr l)))))
+  (loop data))
+
+(define (repeat n)
+  (if (= n 0)
+      'done
+      (begin
+        (search 5000)
+        (repeat (- n 1)))))
+
+(repeat 50)
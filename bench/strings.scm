@@ -0,0 +1,12 @@
+;;; Convert between numbers, strings and symbols.
+
+(define (churn n)
+  (let loop ((i 0) (total 0))
+    (if (= i n)
+        total
+        (let* ((s (number->string i))
+               (sym (string->symbol s)))
+          (loop (+ i 1)
+                (+ total (string->number (symbol->string sym))))))))
+
+(churn 20000)
@@ -0,0 +1,15 @@
+;;; Count occurrences of 500 distinct list keys in a stream of 20000,
+;;; in an equal? hash table.
+
+(define (key i)
+  (list 'k (remainder (* i 7919) 500)))
+
+(define (tally n)
+  (let ((counts (make-hash-table)))
+    (do ((i 0 (+ i 1)))
+        ((= i n) (hash-table-count counts))
+      (let ((k (key i)))
+        (hash-table-set! counts k
+                         (+ 1 (hash-table-ref/default counts k 0)))))))
+
+(tally 20000)
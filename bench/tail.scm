@@ -0,0 +1,19 @@
+;;; Loops whose recursive call is in tail position in each kind of
+;;; form.  Tail calls run in constant space, so an engine that misses
+;;; one shows up as memory growing with the number of iterations.
+
+(define n 100000)
+
+(define (loop-if i) (if (= i 0) #t (loop-if (- i 1))))
+(define (loop-cond i) (cond ((= i 0) #t) (else (loop-cond (- i 1)))))
+(define (loop-case i) (case i ((0) #t) (else (loop-case (- i 1)))))
+(define (loop-and i) (and (>= i 0) (if (= i 0) #t (loop-and (- i 1)))))
+(define (loop-or i) (or (= i 0) (loop-or (- i 1))))
+(define (loop-begin i) (begin (if (= i 0) #t (loop-begin (- i 1)))))
+(define (loop-let i) (let ((j (- i 1))) (if (< j 0) #t (loop-let j))))
+(define (loop-apply i) (if (= i 0) #t (apply loop-apply (list (- i 1)))))
+
+(if (and (loop-if n) (loop-cond n) (loop-case n) (loop-and n) (loop-or n)
+         (loop-begin n) (loop-let n) (loop-apply n))
+    'done
+    'failed)
@@ -0,0 +1,18 @@
+;;; Build a long report a line at a time, then scan it a character
+;;; at a time.
+
+(define (report n)
+  (let ((text (make-string 0)))
+    (do ((i 0 (+ i 1)))
+        ((= i n) text)
+      (string-append! text "item " (number->string i) ": "
+                      (symbol->string 'widget) "\n"))))
+
+(define (count-lines s)
+  (let ((n (string-length s)))
+    (let loop ((i 0) (lines 0))
+      (cond ((= i n) lines)
+            ((eqv? (string-ref s i) #\newline) (loop (+ i 1) (+ lines 1)))
+            (else (loop (+ i 1) lines))))))
+
+(count-lines (report 4000))
@@ -0,0 +1,14 @@
+;;; Count the primes below 30000 with a sieve in a vector.
+
+(define (sieve n)
+  (let ((composite (make-vector n #f)))
+    (let loop ((i 2) (count 0))
+      (cond ((= i n) count)
+            ((vector-ref composite i) (loop (+ i 1) count))
+            (else
+             (do ((j (* i i) (+ j i)))
+                 ((not (< j n)))
+               (vector-set! composite j #t))
+             (loop (+ i 1) (+ count 1)))))))
+
+(sieve 30000)
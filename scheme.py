@@ -1,7 +1,21 @@
-#!/usr/bin/python
-
-import string
+#!/usr/bin/python3
+
+import array
+import fractions
+import hashlib
+import io
+import itertools
+import marshal
+import math
+import mmap
+import operator
+import os
+import pickle
+import re
 import sys
+import threading
+import time
+import weakref
 
 # TODO: reimplement reader in PLY.
 # TODO: reimplement writer as methods.
@@ -11,15 +25,19 @@ import sys
 # Scheme Type                   Python Type
 # ------ ----                   ------ ----
 #   boolean                       bool
-#   integer                       int, long
+#   number                        int, Fraction, float
 #   character                     class Character(str)
-#   string                        class String(str)
-#   symbol			  class Symbol(str)
+#   string                        class String
+#   vector                        class Vector(list)
+#   f64vector                     class F64Vector
+#   hash table                    class HashTable
+#   symbol			  class Symbol
 #   empty list			  None
-#   pair			  class Pair(list)
-#   procedure                     <type 'function'>
+#   pair			  class Pair
+#   procedure                     class Procedure
 #   environment                   class Environment(dict)
-#   port                          file
+#                                 class Frame (procedure locals)
+#   port                          class InputPort, OutputPort
 #   eof-object                    type(class EOF)
 
 class Character(str):
@@ -36,330 +54,1148 @@ class Character(str):
         'space'    : ' ',
         'delete'   : '\0177',
         }
-    char_to_name = dict((c, n) for n, c in name_to_char.iteritems())
+    char_to_name = dict((c, n) for n, c in name_to_char.items())
     name_to_char['linefeed'] = '\n'  # synonym for #\newline
 
-class String(str):
+# string-ref and friends return these rather than new Characters.
+characters = [Character(chr(i)) for i in range(256)]
+
+# Strings are mutable, so a String keeps its characters in a bytearray:
+# string-ref and string-set! are O(1), and string-append! grows the
+# buffer in place in amortized O(1) per character.  str() of a String
+# is a copy of its characters, for file names and the like.  Characters
+# are the 256 Latin-1 code points, the same as the bytes ports read and
+# write, so a String is made from a str by encoding it as Latin-1.
+
+class String(object):
+    __slots__ = ('chars',)
+
     escapes = 'abtnvfr"\\'
     escape_to_char = dict((e, eval('"\\%s"' % e)) for e in escapes)
-    char_to_escape = dict((c, e) for e, c in escape_to_char.iteritems())
+    char_to_escape = dict((c, e) for e, c in escape_to_char.items())
 
+    def __init__(self, chars=''):
+        if isinstance(chars, str):
+            chars = chars.encode('latin-1')
+        self.chars = bytearray(chars)
 
-class Symbol(str):
+    def __str__(self):
+        return self.chars.decode('latin-1')
 
-    all = {}
+class Vector(list):
+    __slots__ = ()
 
-    def __new__(cls, value):
-        try:
-            return cls.all[value]
-        except KeyError:
-            new_sym = super(Symbol, cls).__new__(cls, value)
-            cls.all[value] = new_sym
-            return new_sym
 
+# Symbols are interned, so they compare and hash by identity, and
+# dictionaries keyed by symbol need no string hashing.  Symbol.all
+# holds them for good.  A symbol created with weak=True is held in
+# Symbol.weak instead, and goes away when nothing else refers to it;
+# string->symbol and read create weak symbols when --weak-symbols is
+# given, so that a process reading arbitrary symbols from its input
+# doesn't grow without bound.
 
-class Pair(list):
-    pass
+class Symbol(object):
+    __slots__ = ('name', '__weakref__')
 
-def cons(car, cdr):
-    return Pair([car, cdr])
+    all = {}
+    weak = weakref.WeakValueDictionary()
+
+    def __new__(cls, name, weak=False):
+        sym = cls.all.get(name)
+        if sym is None:
+            sym = cls.weak.get(name)
+            if sym is None:
+                sym = object.__new__(cls)
+                sym.name = str(name)
+                if weak:
+                    cls.weak[sym.name] = sym
+                else:
+                    cls.all[sym.name] = sym
+        return sym
+
+    def __reduce__(self):
+        if self is Symbol.all.get(self.name):
+            return Symbol, (self.name,)
+        if self is Symbol.weak.get(self.name):
+            return Symbol, (self.name, True)
+        return uninterned_symbol, (self.name,)
+
+    def __str__(self):
+        return self.name
+
+    __repr__ = __str__
+
+# A symbol in neither table, equal to no other symbol, even one with the
+# same name.
+def uninterned_symbol(name):
+    sym = object.__new__(Symbol)
+    sym.name = str(name)
+    return sym
+
+
+class Pair(object):
+    __slots__ = ('car', 'cdr')
+
+    def __init__(self, car, cdr):
+        self.car = car
+        self.cdr = cdr
+
+cons = Pair
 
 def car(pair):
-    assert isinstance(pair, Pair)
-    return pair[0]
+    return pair.car
 
 def cdr(pair):
-    assert isinstance(pair, Pair)
-    return pair[1]
+    return pair.cdr
 
 def caar(pair):
-    assert isinstance(pair, Pair)
-    assert isinstance(pair[0], Pair)
-    return pair[0][0]
-    
+    return pair.car.car
+
 def cadr(pair):
-    assert isinstance(pair, Pair)
-    assert isinstance(pair[1], Pair)
-    return pair[1][0]
-    
+    return pair.cdr.car
+
 def cdar(pair):
-    assert isinstance(pair, Pair)
-    assert isinstance(pair[0], Pair)
-    return pair[0][1]
-    
+    return pair.car.cdr
+
 def cddr(pair):
-    assert isinstance(pair, Pair)
-    assert isinstance(pair[1], Pair)
-    return pair[1][1]
-    
+    return pair.cdr.cdr
+
 def caddr(pair):
-    assert isinstance(pair, Pair)
-    assert isinstance(pair[1], Pair)
-    assert isinstance(pair[1][1], Pair)
-    return pair[1][1][0]
+    return pair.cdr.cdr.car
 
 def cdddr(pair):
-    assert isinstance(pair, Pair)
-    assert isinstance(pair[1], Pair)
-    assert isinstance(pair[1][1], Pair)
-    return pair[1][1][1]
+    return pair.cdr.cdr.cdr
 
 def cadddr(pair):
-    assert isinstance(pair, Pair)
-    assert isinstance(pair[1], Pair)
-    assert isinstance(pair[1][1], Pair)
-    assert isinstance(pair[1][1][1], Pair)
-    return pair[1][1][1][0]
-
-def setcar(pair, new_car):
-    assert isinstance(pair, Pair)
-    pair[0] = new_car
-    
-def setcdr(pair, new_cdr):
-    assert isinstance(pair, Pair)
-    pair[1] = new_cdr
-
-def ziplists(*lists):
-    while all(lists):
-        yield [car(list) for list in lists]
-        lists = [cdr(list) for list in lists]
-
-def make_compound_proc(params, body, env):
-    body = cons(Symbol('begin'), body)
-    return lambda args: (body, Environment.extend(params, args, env))
-
-def is_primitive_proc(exp):
-    return isinstance(exp, type(lambda: None)) and exp.func_name != '<lambda>'
+    return pair.cdr.cdr.cdr.car
+
+def python_list(lst, who):
+    items = []
+    while isinstance(lst, Pair):
+        items.append(lst.car)
+        lst = lst.cdr
+    if lst is not None:
+        exit('%s: not a proper list' % who)
+    return items
+
+def scheme_list(items, tail=None):
+    for item in reversed(items):
+        tail = cons(item, tail)
+    return tail
+
+def reverse(lst):
+    result = None
+    while isinstance(lst, Pair):
+        result = cons(lst.car, result)
+        lst = lst.cdr
+    return result
+
+def check_pair(obj, who):
+    if not isinstance(obj, Pair):
+        exit('%s: not a pair' % who)
+    return obj
+
+def check_string(obj, who):
+    if not isinstance(obj, String):
+        exit('%s: not a string' % who)
+    return obj
+
+# File names go to the OS as the string's bytes, so a name means the
+# same file whatever the locale.
+def check_path(obj, who):
+    return bytes(check_string(obj, who).chars)
+
+def check_char(obj, who):
+    if not isinstance(obj, Character):
+        exit('%s: not a character' % who)
+    return obj
+
+def check_vector(obj, who):
+    if not isinstance(obj, Vector):
+        exit('%s: not a vector' % who)
+    return obj
+
+def check_index(k, n, who):
+    if not isinstance(k, int) or not 0 <= k < n:
+        exit('%s: index out of range' % who)
+    return k
+
+# Procedures
+#
+# Every procedure has an apply(args, k) method, called by the machine
+# with the arguments and the current continuation.  It returns the
+# machine's next (node, env, k) or (None, value, k) triple.  args is a
+# fresh Python list which the procedure may keep; no Scheme list is
+# built unless a rest parameter needs one.
+#
+# A Primitive wraps a Python function which takes the arguments as
+# positional parameters.  A Control primitive, like call/cc or map,
+# also gets the continuation as its first parameter and returns a
+# triple itself.  A Compound procedure is a Lambda node closed over the
+# environment it was created in; its argument list becomes the values
+# of its Frame.
+
+class Procedure(object):
+    __slots__ = ()
+
+class Primitive(Procedure):
+    __slots__ = ('name', 'func', 'min_args', 'max_args', 'limit')
+
+    def __init__(self, name, func, min_args, max_args):
+        self.name = name
+        self.func = func
+        self.min_args = min_args
+        self.max_args = max_args    # None if variadic
+        self.limit = sys.maxsize if max_args is None else max_args
+
+    def __reduce__(self):
+        return primitive_named, (self.name,)
+
+    def wrong_arity(self):
+        exit('%s: wrong number of arguments' % self.name)
+
+    def call(self, args):
+        if not self.min_args <= len(args) <= self.limit:
+            self.wrong_arity()
+        return self.func(*args)
+
+    def apply(self, args, k):
+        if not self.min_args <= len(args) <= self.limit:
+            self.wrong_arity()
+        return None, self.func(*args), k
+
+class Control(Primitive):
+    __slots__ = ()
+
+    def apply(self, args, k):
+        if not self.min_args <= len(args) <= self.limit:
+            self.wrong_arity()
+        return self.func(k, *args)
+
+class Compound(Procedure):
+    __slots__ = ('code', 'env')
+
+    def __init__(self, code, env):
+        self.code = code
+        self.env = env
+
+    def apply(self, args, k):
+        return self.code.body, self.code.bind(args, self.env), k
+
+# Every primitive by name, for loading images.
+primitives = {}
+
+def primitive_named(name):
+    return primitives[name]
+
+def apply_procedure(proc, args, k):
+    if not isinstance(proc, Procedure):
+        exit('attempt to apply a non-procedure')
+    return proc.apply(args, k)
 
 class EOF(object):
     pass
 
-def is_null_proc(args):
-    return car(args) is None
+class Unassigned(object):
+    pass
+
+def is_null_proc(obj):
+    return obj is None
 
-def is_boolean_proc(args):
-    return isinstance(car(args), bool)
+def is_boolean_proc(obj):
+    return isinstance(obj, bool)
 
-def is_symbol_proc(args):
-    return isinstance(car(args), Symbol)
+def is_symbol_proc(obj):
+    return isinstance(obj, Symbol)
 
-def is_integer_proc(args):
-    return isinstance(car(args), (int, long))
+def is_char_proc(obj):
+    return isinstance(obj, Character)
 
-def is_char_proc(args):
-    return isinstance(car(args), Character)
+def is_string_proc(obj):
+    return isinstance(obj, String)
 
-def is_string_proc(args):
-    return isinstance(car(args), String)
+def is_pair_proc(obj):
+    return isinstance(obj, Pair)
 
-def is_pair_proc(args):
-    return isinstance(car(args), Pair)
+def is_vector_proc(obj):
+    return isinstance(obj, Vector)
 
-def is_procedure_proc(args):
-    return isinstance(car(args), type(lambda: None))
+def is_procedure_proc(obj):
+    return isinstance(obj, Procedure)
 
-def char_to_integer_proc(args):
-    return ord(car(args))
+def char_to_integer_proc(c):
+    return ord(c)
 
-def integer_to_char_proc(args):
-    return Character(chr(car(args)))
+def integer_to_char_proc(n):
+    if not isinstance(n, int) or not 0 <= n < len(characters):
+        exit('integer->char: out of range')
+    return characters[n]
 
-def number_to_string_proc(args):
-    return String(car(args))
+# Set by --weak-symbols.
+weak_symbols = False
 
-def string_to_number_proc(args):
-    return int(car(args))
+def symbol_to_string_proc(sym):
+    return String(sym.name)
 
-def symbol_to_string_proc(args):
-    return String(car(args))
+def string_to_symbol_proc(s):
+    return Symbol(str(check_string(s, 'string->symbol')), weak_symbols)
 
-def string_to_symbol_proc(args):
-    return Symbol(car(args))
+def make_string_proc(k, c=characters[ord(' ')]):
+    if not isinstance(k, int) or k < 0:
+        exit('make-string: bad length')
+    return String(check_char(c, 'make-string') * k)
 
-def add_proc(args):
-    result = 0
-    while args:
-        result += car(args)
-        args = cdr(args)
-    return result
+def string_proc(*chars):
+    for c in chars:
+        check_char(c, 'string')
+    return String(''.join(chars))
 
-def sub_proc(args):
-    if cdr(args) is None:
-        return -car(args)
-    result = car(args)
-    args = cdr(args)
-    while args:
-        result -= car(args)
-        args = cdr(args)
-    return result
+def string_length_proc(s):
+    return len(check_string(s, 'string-length').chars)
 
-def mul_proc(args):
-    result = 1
-    while args:
-        result *= car(args)
-        args = cdr(args)
+def string_ref_proc(s, k):
+    chars = check_string(s, 'string-ref').chars
+    return characters[chars[check_index(k, len(chars), 'string-ref')]]
+
+def string_set_proc(s, k, c):
+    chars = check_string(s, 'string-set!').chars
+    k = check_index(k, len(chars), 'string-set!')
+    chars[k] = ord(check_char(c, 'string-set!'))
+    return Symbol('ok')
+
+def make_string_compare_proc(name, test, fold):
+    def string_compare_proc(s, *args):
+        s = check_string(s, name).chars
+        if fold:
+            s = s.lower()
+        for s1 in args:
+            s1 = check_string(s1, name).chars
+            if fold:
+                s1 = s1.lower()
+            if not test(s, s1):
+                return False
+            s = s1
+        return True
+    return string_compare_proc
+
+string_comparisons = [
+    ('=?',  operator.eq),
+    ('<?',  operator.lt),
+    ('>?',  operator.gt),
+    ('<=?', operator.le),
+    ('>=?', operator.ge),
+    ]
+
+def substring_proc(s, start, end):
+    chars = check_string(s, 'substring').chars
+    if not (isinstance(start, int) and isinstance(end, int) and
+            0 <= start <= end <= len(chars)):
+        exit('substring: index out of range')
+    return String(chars[start:end])
+
+def string_append_proc(*strings):
+    chars = bytearray()
+    for s in strings:
+        chars += check_string(s, 'string-append').chars
+    result = String()
+    result.chars = chars
     return result
-    
-def quotient_proc(args):
-    return car(args) / cadr(args)
 
-def remainder_proc(args):
-    return car(args) % cadr(args)
+# Not in R5RS: append to s in place, for building long strings a piece
+# at a time without copying what's there already.
+def string_append_bang_proc(s, *strings):
+    chars = check_string(s, 'string-append!').chars
+    for s1 in strings:
+        chars += check_string(s1, 'string-append!').chars
+    return Symbol('ok')
 
-def is_equal_proc(args):
-    z1 = car(args)
-    args = cdr(args)
-    while args:
-        z0, z1, args = z1, car(args), cdr(args)
-        if z0 != z1:
-            return False
-    return True
+def string_to_list_proc(s):
+    return scheme_list([characters[c]
+                        for c in check_string(s, 'string->list').chars])
 
-def is_less_than_proc(args):
-    z1 = car(args)
-    args = cdr(args)
-    while args:
-        z0, z1, args = z1, car(args), cdr(args)
-        if z0 >= z1:
-            return False
-    return True
+def list_to_string_proc(lst):
+    return string_proc(*python_list(lst, 'list->string'))
 
-def is_greater_then_proc(args):
-    z1 = car(args)
-    args = cdr(args)
-    while args:
-        z0, z1, args = z1, car(args), cdr(args)
-        if z0 <= z1:
-            return False
-    return True
+def string_copy_proc(s):
+    return String(check_string(s, 'string-copy').chars)
 
-def cons_proc(args):
-    return cons(car(args), cadr(args))
+def string_fill_proc(s, c):
+    chars = check_string(s, 'string-fill!').chars
+    chars[:] = bytearray([ord(check_char(c, 'string-fill!'))]) * len(chars)
+    return Symbol('ok')
+
+def make_vector_proc(k, fill=False):
+    if not isinstance(k, int) or k < 0:
+        exit('make-vector: bad length')
+    return Vector([fill] * k)
 
-def car_proc(args):
-    return caar(args)
+def vector_proc(*args):
+    return Vector(args)
 
-def cdr_proc(args):
-    return cdar(args)
+def vector_length_proc(v):
+    return len(check_vector(v, 'vector-length'))
 
-def set_car_proc(args):
-    setcar(car(args), cadr(args))
+def vector_ref_proc(v, k):
+    v = check_vector(v, 'vector-ref')
+    return v[check_index(k, len(v), 'vector-ref')]
+
+def vector_set_proc(v, k, obj):
+    v = check_vector(v, 'vector-set!')
+    v[check_index(k, len(v), 'vector-set!')] = obj
     return Symbol('ok')
 
-def set_cdr_proc(args):
-    setcdr(car(args), cadr(args))
+def vector_to_list_proc(v):
+    return scheme_list(check_vector(v, 'vector->list'))
+
+def list_to_vector_proc(lst):
+    return Vector(python_list(lst, 'list->vector'))
+
+def vector_fill_proc(v, obj):
+    v = check_vector(v, 'vector-fill!')
+    v[:] = [obj] * len(v)
     return Symbol('ok')
 
-def list_proc(args):
-    return args
+# Numbers
+#
+# The numeric tower is Python's: exact integers are ints, other exact
+# rationals are Fractions, and inexact reals are floats.  Python already
+# mixes them the way Scheme does, except that it never turns a Fraction
+# with denominator 1 back into an integer, so exact_rational() does that
+# for any Fraction result, and that / on integers isn't exact division.
+# The arithmetic and comparison primitives handle two ints, by far the
+# commonest case, before anything else, and only then check types and
+# loop.
+
+Fraction = fractions.Fraction
+
+number_types = (int, Fraction, float)
+integer_types = (int,)
+
+def is_number(obj):
+    return isinstance(obj, number_types) and obj.__class__ is not bool
+
+def check_number(z, who):
+    if not is_number(z):
+        exit('%s: not a number' % who)
+    return z
+
+def check_integer(n, who):
+    if not (n.__class__ in integer_types or
+            n.__class__ is float and n.is_integer()):
+        exit('%s: not an integer' % who)
+    return n
+
+def exact_rational(q):
+    return q.numerator if q.denominator == 1 else q
+
+def arithmetic(name, op, z, args):
+    # Python's operators accept some non-numbers, like booleans, and
+    # lists and characters with *, so the operands are checked first.
+    check_number(z, name)
+    for z1 in args:
+        check_number(z1, name)
+    try:
+        for z1 in args:
+            z = op(z, z1)
+    except OverflowError:
+        exit('%s: number too large' % name)
+    if z.__class__ is Fraction:
+        return exact_rational(z)
+    return z
+
+def add_proc(z1=0, z2=0, *args):
+    if z1.__class__ is int is z2.__class__ and not args:
+        return z1 + z2
+    return arithmetic('+', operator.add, z1, (z2,) + args)
+
+def sub_proc(z1, z2=Unassigned, *args):
+    if z1.__class__ is int is z2.__class__ and not args:
+        return z1 - z2
+    if z2 is Unassigned:
+        return arithmetic('-', operator.sub, 0, (z1,))
+    return arithmetic('-', operator.sub, z1, (z2,) + args)
+
+def mul_proc(z1=1, z2=1, *args):
+    if z1.__class__ is int is z2.__class__ and not args:
+        return z1 * z2
+    return arithmetic('*', operator.mul, z1, (z2,) + args)
+
+def divide(z1, z2):
+    if z2 == 0:
+        exit('/: division by zero')
+    if z1.__class__ in integer_types and z2.__class__ in integer_types:
+        return exact_rational(Fraction(z1, z2))
+    z = z1 / z2
+    return z if z.__class__ is not Fraction else exact_rational(z)
+
+def div_proc(z, *args):
+    check_number(z, '/')
+    for z1 in args:
+        check_number(z1, '/')
+    try:
+        if not args:
+            return divide(1, z)
+        for z1 in args:
+            z = divide(z, z1)
+    except OverflowError:
+        exit('/: number too large')
+    return z
+
+def check_divisor(n1, n2, who):
+    check_integer(n1, who)
+    if check_integer(n2, who) == 0:
+        exit('%s: division by zero' % who)
+
+# quotient and remainder truncate toward zero, modulo rounds toward
+# negative infinity, as Python's // and % do.
+
+def quotient_proc(n1, n2):
+    check_divisor(n1, n2, 'quotient')
+    if n1 >= 0 and n2 > 0:
+        return n1 // n2
+    q = abs(n1) // abs(n2)
+    return q if (n1 < 0) == (n2 < 0) else -q
+
+def remainder_proc(n1, n2):
+    check_divisor(n1, n2, 'remainder')
+    if n1 >= 0 and n2 > 0:
+        return n1 % n2
+    r = abs(n1) % abs(n2)
+    return r if n1 >= 0 else -r
+
+def modulo_proc(n1, n2):
+    check_divisor(n1, n2, 'modulo')
+    return n1 % n2
+
+def compare(name, test, z, args):
+    check_number(z, name)
+    for z1 in args:
+        if z1 is not Unassigned and not test(z, check_number(z1, name)):
+            return False
+        z = z1
+    return True
 
-def is_eq_proc(args):
-    z1 = car(args)
-    args = cdr(args)
-    while args:
-        z0, z1, args = z1, car(args), cdr(args)
-        if z0 is not z1:
+def is_equal_number_proc(z, z1=Unassigned, *args):
+    if z.__class__ is int is z1.__class__ and not args:
+        return z == z1
+    return compare('=', operator.eq, z, (z1,) + args)
+
+def is_less_than_proc(z, z1=Unassigned, *args):
+    if z.__class__ is int is z1.__class__ and not args:
+        return z < z1
+    return compare('<', operator.lt, z, (z1,) + args)
+
+def is_greater_than_proc(z, z1=Unassigned, *args):
+    if z.__class__ is int is z1.__class__ and not args:
+        return z > z1
+    return compare('>', operator.gt, z, (z1,) + args)
+
+def is_less_or_equal_proc(z, z1=Unassigned, *args):
+    if z.__class__ is int is z1.__class__ and not args:
+        return z <= z1
+    return compare('<=', operator.le, z, (z1,) + args)
+
+def is_greater_or_equal_proc(z, z1=Unassigned, *args):
+    if z.__class__ is int is z1.__class__ and not args:
+        return z >= z1
+    return compare('>=', operator.ge, z, (z1,) + args)
+
+def is_number_proc(obj):
+    return is_number(obj)
+
+def is_rational_proc(obj):
+    if obj.__class__ is float:
+        return not (math.isinf(obj) or math.isnan(obj))
+    return is_number(obj)
+
+def is_integer_proc(obj):
+    return (obj.__class__ in integer_types or
+            obj.__class__ is float and obj.is_integer())
+
+def is_exact_proc(z):
+    return check_number(z, 'exact?').__class__ is not float
+
+def is_inexact_proc(z):
+    return check_number(z, 'inexact?').__class__ is float
+
+def is_zero_proc(z):
+    return check_number(z, 'zero?') == 0
+
+def is_positive_proc(z):
+    return check_number(z, 'positive?') > 0
+
+def is_negative_proc(z):
+    return check_number(z, 'negative?') < 0
+
+def is_odd_proc(n):
+    return check_integer(n, 'odd?') % 2 == 1
+
+def is_even_proc(n):
+    return check_integer(n, 'even?') % 2 == 0
+
+def max_proc(z, *args):
+    result = check_number(z, 'max')
+    inexact = z.__class__ is float
+    for z1 in args:
+        inexact = inexact or check_number(z1, 'max').__class__ is float
+        if z1 > result:
+            result = z1
+    return float(result) if inexact else result
+
+def min_proc(z, *args):
+    result = check_number(z, 'min')
+    inexact = z.__class__ is float
+    for z1 in args:
+        inexact = inexact or check_number(z1, 'min').__class__ is float
+        if z1 < result:
+            result = z1
+    return float(result) if inexact else result
+
+def abs_proc(z):
+    return abs(check_number(z, 'abs'))
+
+def floor_proc(z):
+    if check_number(z, 'floor').__class__ is Fraction:
+        return z.numerator // z.denominator
+    if z.__class__ is float and math.isfinite(z):
+        return float(math.floor(z))
+    return z
+
+def ceiling_proc(z):
+    if check_number(z, 'ceiling').__class__ is Fraction:
+        return -(-z.numerator // z.denominator)
+    if z.__class__ is float and math.isfinite(z):
+        return float(math.ceil(z))
+    return z
+
+def truncate_proc(z):
+    if check_number(z, 'truncate') >= 0:
+        return floor_proc(z)
+    return ceiling_proc(z)
+
+def round_proc(z):
+    # To even, as R5RS says, where Python's round() goes away from 0.
+    fl = floor_proc(check_number(z, 'round'))
+    diff = z - fl
+    if diff > Fraction(1, 2) or diff == Fraction(1, 2) and fl % 2 == 1:
+        return fl + 1
+    return fl
+
+def exact_to_inexact_proc(z):
+    try:
+        return float(check_number(z, 'exact->inexact'))
+    except OverflowError:
+        exit('exact->inexact: number too large')
+
+def inexact_to_exact_proc(z):
+    if check_number(z, 'inexact->exact').__class__ is not float:
+        return z
+    if math.isinf(z) or math.isnan(z):
+        exit('inexact->exact: no exact equivalent')
+    return exact_rational(Fraction(z))
+
+def exact_sqrt(n):
+    # The exact square root of a non-negative integer, or None.
+    if n < 2:
+        return n
+    r = int(math.sqrt(n)) if n < 1 << 52 else 1 << (n.bit_length() + 1) // 2
+    while r * r > n:
+        r = (r + n // r) // 2
+    return r if r * r == n else None
+
+def sqrt_proc(z):
+    if check_number(z, 'sqrt') < 0:
+        exit('sqrt: negative argument')
+    if z.__class__ in integer_types:
+        r = exact_sqrt(z)
+        if r is not None:
+            return r
+    elif z.__class__ is Fraction:
+        num, den = exact_sqrt(z.numerator), exact_sqrt(z.denominator)
+        if num is not None and den is not None:
+            return Fraction(num, den)
+    try:
+        return math.sqrt(z)
+    except OverflowError:
+        exit('sqrt: number too large')
+
+def expt_proc(z1, z2):
+    check_number(z1, 'expt')
+    if check_number(z2, 'expt').__class__ in integer_types:
+        if z1.__class__ is float:
+            pass
+        elif z2 >= 0:
+            z = z1 ** z2
+            return z if z.__class__ is not Fraction else exact_rational(z)
+        elif z1 == 0:
+            exit('expt: division by zero')
+        else:
+            return exact_rational(Fraction(z1) ** z2)
+    try:
+        z = float(z1) ** float(z2)
+    except (ZeroDivisionError, OverflowError):
+        z = None
+    if z.__class__ is not float:
+        # A negative number to a fractional power is complex.
+        exit('expt: result is not a real number')
+    return z
+
+def make_math_proc(name, func):
+    def math_proc(*args):
+        try:
+            return func(*[float(check_number(z, name)) for z in args])
+        except (ValueError, OverflowError):
+            exit('%s: argument out of range' % name)
+    return math_proc
+
+math_procs = [
+    ('exp',  math.exp,  1, 1),
+    ('log',  math.log,  1, 1),
+    ('sin',  math.sin,  1, 1),
+    ('cos',  math.cos,  1, 1),
+    ('tan',  math.tan,  1, 1),
+    ('asin', math.asin, 1, 1),
+    ('acos', math.acos, 1, 1),
+    ('atan', lambda y, x=1.0: math.atan2(y, x), 1, 2),
+    ]
+
+# The reader's token_re uses this pattern too.
+number_pattern = r"""
+    [+-]? (?: [0-9]+ / [0-9]+
+            | (?: [0-9]+ \.? [0-9]* | \. [0-9]+ ) (?: [eE] [+-]? [0-9]+ )? )
+  | [+-] (?: inf | nan ) \.0
+"""
+number_re = re.compile(r'(?:%s)\Z' % number_pattern, re.VERBOSE)
+radix_number_re = re.compile(r'[+-]?[0-9a-zA-Z]+\Z')
+
+def parse_number(token):
+    # Raises ValueError if token doesn't match number_re.
+    if '/' in token:
+        num, den = token.split('/')
+        if int(den) == 0:
+            raise ValueError('division by zero')
+        return exact_rational(Fraction(int(num), int(den)))
+    if token.endswith('.0') and token[1:4] in ('inf', 'nan'):
+        return float(token[:-2])
+    if '.' in token or 'e' in token or 'E' in token:
+        return float(token)
+    return int(token)
+
+def format_number(z):
+    if z.__class__ is float:
+        if math.isnan(z):
+            return '+nan.0'
+        if math.isinf(z):
+            return '+inf.0' if z > 0 else '-inf.0'
+        return repr(z)
+    if z.__class__ is Fraction:
+        return '%d/%d' % (z.numerator, z.denominator)
+    return str(z)
+
+radix_digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+def number_to_string_proc(z, radix=10):
+    check_number(z, 'number->string')
+    if radix == 10:
+        return String(format_number(z))
+    if radix not in (2, 8, 16) or z.__class__ not in integer_types:
+        exit('number->string: radix %s needs an exact integer' % radix)
+    n, digits = abs(z), []
+    while True:
+        n, d = divmod(n, radix)
+        digits.append(radix_digits[d])
+        if not n:
+            break
+    if z < 0:
+        digits.append('-')
+    return String(''.join(reversed(digits)))
+
+def string_to_number_proc(s, radix=10):
+    s = str(check_string(s, 'string->number'))
+    if radix != 10:
+        if radix not in (2, 8, 16):
+            exit('string->number: bad radix %s' % radix)
+        if not radix_number_re.match(s):
+            return False
+        try:
+            return int(s, radix)
+        except ValueError:
+            return False
+    if not number_re.match(s):
+        return False
+    try:
+        return parse_number(s)
+    except ValueError:
+        return False
+
+# Numeric vectors
+#
+# An f64vector (SRFI 4) holds floats in an array('d').  Besides the
+# SRFI 4 procedures there are bulk operations, which loop in C with
+# map(), math.fsum() and slicing rather than calling back into the
+# machine for each element: elementwise f64vector+, f64vector-,
+# f64vector* and f64vector/ (of two vectors, or a vector and a
+# number), f64vector-sum, f64vector-dot and f64vector-copy of a
+# slice.  f64vector-map calls a primitive from map() too; only a
+# compound procedure is called through the machine.
+
+class F64Vector(object):
+    __slots__ = ('items',)
+
+    def __init__(self, items=()):
+        if not isinstance(items, array.array):
+            items = array.array('d', items)
+        self.items = items
+
+def check_f64vector(obj, who):
+    if not isinstance(obj, F64Vector):
+        exit('%s: not an f64vector' % who)
+    return obj
+
+# Every element stored in an f64vector goes through real_item(), which
+# refuses booleans, which float() would take as 0 and 1, and exact
+# integers too big for a float.
+def real_item(z, who):
+    if not is_number(z):
+        exit('%s: not a real number' % who)
+    try:
+        return float(z)
+    except OverflowError:
+        exit('%s: number too large' % who)
+
+def real_items(items, who):
+    return [real_item(z, who) for z in items]
+
+def make_f64vector_proc(k, fill=0.0):
+    if not isinstance(k, int) or k < 0:
+        exit('make-f64vector: bad length')
+    fill = real_item(fill, 'make-f64vector')
+    return F64Vector(array.array('d', [fill]) * k)
+
+def f64vector_proc(*args):
+    return F64Vector(real_items(args, 'f64vector'))
+
+def is_f64vector_proc(obj):
+    return isinstance(obj, F64Vector)
+
+def f64vector_length_proc(v):
+    return len(check_f64vector(v, 'f64vector-length').items)
+
+def f64vector_ref_proc(v, k):
+    items = check_f64vector(v, 'f64vector-ref').items
+    return items[check_index(k, len(items), 'f64vector-ref')]
+
+def f64vector_set_proc(v, k, z):
+    items = check_f64vector(v, 'f64vector-set!').items
+    k = check_index(k, len(items), 'f64vector-set!')
+    items[k] = real_item(z, 'f64vector-set!')
+    return Symbol('ok')
+
+def f64vector_to_list_proc(v):
+    return scheme_list(check_f64vector(v, 'f64vector->list').items.tolist())
+
+def list_to_f64vector_proc(lst):
+    items = python_list(lst, 'list->f64vector')
+    return F64Vector(real_items(items, 'list->f64vector'))
+
+def f64vector_copy_proc(v, start=0, end=None):
+    items = check_f64vector(v, 'f64vector-copy').items
+    if end is None:
+        end = len(items)
+    if not (isinstance(start, int) and isinstance(end, int) and
+            0 <= start <= end <= len(items)):
+        exit('f64vector-copy: index out of range')
+    return F64Vector(items[start:end])
+
+def make_f64vector_op_proc(name, op):
+    def f64vector_op_proc(v1, v2):
+        items = check_f64vector(v1, name).items
+        if isinstance(v2, F64Vector):
+            if len(v2.items) != len(items):
+                exit('%s: vectors differ in length' % name)
+            others = v2.items
+        else:
+            others = [real_item(v2, name)] * len(items)
+        try:
+            return F64Vector(map(op, items, others))
+        except ZeroDivisionError:
+            exit('%s: division by zero' % name)
+    return f64vector_op_proc
+
+f64vector_ops = [
+    ('f64vector+', operator.add),
+    ('f64vector-', operator.sub),
+    ('f64vector*', operator.mul),
+    ('f64vector/', operator.truediv),
+    ]
+
+def f64vector_sum_proc(v):
+    return math.fsum(check_f64vector(v, 'f64vector-sum').items)
+
+def f64vector_dot_proc(v1, v2):
+    items1 = check_f64vector(v1, 'f64vector-dot').items
+    items2 = check_f64vector(v2, 'f64vector-dot').items
+    if len(items1) != len(items2):
+        exit('f64vector-dot: vectors differ in length')
+    return math.fsum(map(operator.mul, items1, items2))
+
+def cons_proc(obj1, obj2):
+    return Pair(obj1, obj2)
+
+def car_proc(pair):
+    return check_pair(pair, 'car').car
+
+def cdr_proc(pair):
+    return check_pair(pair, 'cdr').cdr
+
+def set_car_proc(pair, obj):
+    check_pair(pair, 'set-car!').car = obj
+    return Symbol('ok')
+
+def set_cdr_proc(pair, obj):
+    check_pair(pair, 'set-cdr!').cdr = obj
+    return Symbol('ok')
+
+def list_proc(*args):
+    return scheme_list(args)
+
+def make_cxr_proc(name):
+    path = name[-2:0:-1]
+    def cxr_proc(x):
+        for c in path:
+            x = check_pair(x, name)
+            x = x.car if c == 'a' else x.cdr
+        return x
+    return cxr_proc
+
+def length_proc(lst):
+    n = 0
+    while isinstance(lst, Pair):
+        lst = lst.cdr
+        n += 1
+    if lst is not None:
+        exit('length: not a proper list')
+    return n
+
+def append_proc(*lists):
+    if not lists:
+        return None
+    result = lists[-1]
+    for lst in reversed(lists[:-1]):
+        result = scheme_list(python_list(lst, 'append'), result)
+    return result
+
+def reverse_proc(lst):
+    return reverse(lst)
+
+def not_proc(obj):
+    return obj is False
+
+def is_eq_proc(obj, *args):
+    for obj1 in args:
+        if obj is not obj1:
             return False
     return True
 
-def apply_proc(args):
-    exit('apply can not be called')
+def is_eqv(obj1, obj2):
+    if obj1 is obj2:
+        return True
+    if type(obj1) is bool or type(obj2) is bool:
+        return False
+    if isinstance(obj1, number_types) and isinstance(obj2, number_types):
+        return ((obj1.__class__ is float) == (obj2.__class__ is float) and
+                obj1 == obj2)
+    return type(obj1) is Character is type(obj2) and obj1 == obj2
+
+def is_eqv_proc(obj1, obj2):
+    return is_eqv(obj1, obj2)
+
+def is_equal(obj1, obj2):
+    while not is_eqv(obj1, obj2):
+        if isinstance(obj1, Pair):
+            if not (isinstance(obj2, Pair) and is_equal(obj1.car, obj2.car)):
+                return False
+            obj1, obj2 = obj1.cdr, obj2.cdr
+        elif isinstance(obj1, String):
+            return isinstance(obj2, String) and obj1.chars == obj2.chars
+        elif isinstance(obj1, Vector):
+            return (isinstance(obj2, Vector) and len(obj1) == len(obj2) and
+                    all(is_equal(x1, x2) for x1, x2 in zip(obj1, obj2)))
+        elif isinstance(obj1, F64Vector):
+            return isinstance(obj2, F64Vector) and obj1.items == obj2.items
+        else:
+            return False
+    return True
 
-def interaction_environment_proc(args):
+def is_equal_proc(obj1, obj2):
+    return is_equal(obj1, obj2)
+
+def make_member_proc(name, same):
+    def member_proc(obj, lst):
+        while isinstance(lst, Pair):
+            if same(obj, lst.car):
+                return lst
+            lst = lst.cdr
+        return False
+    return member_proc
+
+def make_assoc_proc(name, same):
+    def assoc_proc(obj, alist):
+        while isinstance(alist, Pair):
+            if same(obj, check_pair(alist.car, name).car):
+                return alist.car
+            alist = alist.cdr
+        return False
+    return assoc_proc
+
+memq_proc = make_member_proc('memq', operator.is_)
+memv_proc = make_member_proc('memv', is_eqv)
+member_proc = make_member_proc('member', is_equal)
+assq_proc = make_assoc_proc('assq', operator.is_)
+assv_proc = make_assoc_proc('assv', is_eqv)
+assoc_proc = make_assoc_proc('assoc', is_equal)
+
+def interaction_environment_proc():
     return global_env
 
-def null_environment_proc(args):
+def null_environment_proc(version=None):
     return Environment(None)
 
-def environment_proc(args):
+def environment_proc(version=None):
     env = Environment(None)
     env.populate()
     return env
 
-def eval_proc(args):
-    exit('eval can not be called')
-
-def load_proc(args):
-    fname = car(args)
-    assert isinstance(fname, String)
-    with open(fname) as f:
-        while True:
-            exp = read(f)
-            if exp is EOF:
-                break
+def load_proc(fname):
+    fname = check_path(fname, 'load')
+    result = Symbol('ok')
+    try:
+        key = cache_key(fname)
+    except EnvironmentError as e:
+        exit('load: %s: %s' % (os.fsdecode(fname), e.strerror))
+    # Cached forms have no source locations for the profiler.
+    cache = open_cache(fname, key) if profiler is None else None
+    if cache is not None:
+        for exp in cached_forms(cache, fname):
+            result = scheval(exp, global_env)
+        return result
+    # Write each form before evaluating it, in case the program
+    # mutates its quoted data.
+    with open_input_port(fname) as port, CacheWriter(fname, key) as cache:
+        for exp in read_forms(port):
+            cache.write(exp)
             result = scheval(exp, global_env)
     return result
 
-def read_proc(args):
-    port = sys.stdin if args is None else car(args)
-    return read(port)
+def read_all_proc(source):
+    if isinstance(source, InputPort):
+        return scheme_list(list(read_forms(source, weak_symbols)))
+    with open_input_port(check_path(source, 'read-all')) as port:
+        return scheme_list(list(read_forms(port, weak_symbols)))
+
+def read_proc(port=None):
+    return read(port or stdin_port, weak_symbols)
 
-def read_char_proc(args):
-    port = sys.stdin if args is None else car(args)
-    c = getc(port)
-    return c if c is EOF else Character(c)
+def read_char_proc(port=None):
+    return (port or stdin_port).getc()
 
-def peek_char_proc(args):
-    port = sys.stdin if args is None else car(args)
-    c = peekc(port)
-    return c if c is EOF else Character(c)
+def peek_char_proc(port=None):
+    return (port or stdin_port).peekc()
 
-def is_input_port_proc(args):
-    return isinstance(car(args), file)
+def is_input_port_proc(obj):
+    return isinstance(obj, InputPort)
 
-def open_input_file_proc(args):
-    return open(car(args))
+def current_input_port_proc():
+    return stdin_port
 
-def close_input_port_proc(args):
-    car(args).close()
+def open_input_file_proc(fname):
+    return open_input_port(check_path(fname, 'open-input-file'))
+
+def open_input_string_proc(s):
+    s = check_string(s, 'open-input-string')
+    return InputPort(None, '<string>', bytes(s.chars))
+
+def close_input_port_proc(port):
+    port.close()
     return Symbol('ok')
 
-def is_eof_object_proc(args):
-    return car(args) is EOF
+def is_eof_object_proc(obj):
+    return obj is EOF
+
+def check_output_port(obj, who):
+    if obj is None:
+        return stdout_port
+    if not isinstance(obj, OutputPort):
+        exit('%s: not an output port' % who)
+    return obj
+
+def current_output_port_proc():
+    return stdout_port
+
+# Not in R5RS: the optional buffer size, in bytes.
+def open_output_file_proc(fname, buffer_size=None):
+    if buffer_size is not None and (not isinstance(buffer_size, int)
+                                    or buffer_size < 0):
+        exit('open-output-file: bad buffer size')
+    f = open(check_path(fname, 'open-output-file'), 'wb')
+    return OutputPort(f, buffer_size)
+
+def open_output_string_proc():
+    return OutputPort(None)
+
+def get_output_string_proc(port):
+    if not isinstance(port, OutputPort) or port.file is not None:
+        exit('get-output-string: not a string port')
+    return String(port.getvalue())
+
+def close_output_port_proc(port):
+    check_output_port(port, 'close-output-port').close()
+    return Symbol('ok')
 
-def open_output_file_proc(args):
-    return open(car(args), 'w')
+def flush_output_port_proc(port=None):
+    check_output_port(port, 'flush-output-port').flush()
+    return Symbol('ok')
 
-def close_output_port_proc(args):
-    car(args).close()
+def is_output_port_proc(obj):
+    return isinstance(obj, OutputPort)
+
+def write_char_proc(c, port=None):
+    port = check_output_port(port, 'write-char')
+    port.write(check_char(c, 'write-char'))
+    port.written(c == '\n')
     return Symbol('ok')
 
-def is_output_port_proc(args):
-    port = car(args)
-    return isinstance(port, file) and 'r' in port.mode
+def newline_proc(port=None):
+    port = check_output_port(port, 'newline')
+    port.write('\n')
+    port.written(True)
+    return Symbol('ok')
 
-def write_char_proc(args):
-    c = car(args)
-    assert isinstance(c, Character)
-    port = sys.stdout if cdr(args) is None else cadr(args)
-    port.write(c)
+def write_proc(obj, port=None):
+    port = check_output_port(port, 'write')
+    write(port, obj)
+    port.written()
     return Symbol('ok')
 
-def write_proc(args):
-    obj = car(args)
-    port = sys.stdout if cdr(args) is None else cadr(args)
-    write(port, exp)
-    port.flush()
+def display_proc(obj, port=None):
+    port = check_output_port(port, 'display')
+    write(port, obj, True)
+    port.written(port.line_buffered and isinstance(obj, (Character, String))
+                 and '\n' in str(obj))
     return Symbol('ok')
 
-def error_proc(args):
-    sys.stdout.flush()
-    while args is not None:
-        write(sys.stderr, car(args))
-        sys.stderr.write('\n' if cdr(args) is None else ' ')
-        args = cdr(args)
+def error_proc(*args):
+    stdout_port.flush()
+    last = len(args) - 1
+    for i, obj in enumerate(args):
+        write(sys.stderr, obj)
+        sys.stderr.write('\n' if i == last else ' ')
     exit('exiting')
 
 class Environment(dict):
     def __init__(self, parent):
         self.parent = parent
 
-    @classmethod
-    def extend(cls, vars, values, parent):
-        env = cls(parent)
-        env.update(ziplists(vars, values))
-        return env
-
     def __getitem__(self, var):
         if var in self:
             return self.get(var)
@@ -375,217 +1211,946 @@ class Environment(dict):
             self.parent.set_variable(var, value)
 
     def populate(self):
-        self['null?']                   = is_null_proc
-        self['boolean?']                = is_boolean_proc
-        self['symbol?']                 = is_symbol_proc
-        self['integer?']                = is_integer_proc
-        self['char?']                   = is_char_proc
-        self['string?']                 = is_string_proc
-        self['pair?']                   = is_pair_proc
-        self['procedure?']              = is_procedure_proc
-        self['char->integer']           = char_to_integer_proc
-        self['integer->char']           = integer_to_char_proc
-        self['number->string']          = number_to_string_proc
-        self['string->number']          = string_to_number_proc
-        self['symbol->string']          = symbol_to_string_proc
-        self['string->symbol']          = string_to_symbol_proc
-        self['+']                       = add_proc
-        self['-']                       = sub_proc
-        self['*']                       = mul_proc
-        self['quotient']                = quotient_proc
-        self['remainder']               = remainder_proc
-        self['=']                       = is_equal_proc
-        self['<']                       = is_less_than_proc
-        self['>']                       = is_greater_then_proc
-        self['cons']                    = cons_proc
-        self['car']                     = car_proc
-        self['cdr']                     = cdr_proc
-        self['set-car!']                = set_car_proc
-        self['set-cdr!']                = set_cdr_proc
-        self['list']                    = list_proc
-        self['eq?']                     = is_eq_proc
-        self['apply']                   = apply_proc
-        self['interaction-environment'] = interaction_environment_proc
-        self['null-environment']        = null_environment_proc
-        self['environment']             = environment_proc
-        self['eval']                    = eval_proc
-        self['load']                    = load_proc
-        self['read']                    = read_proc
-        self['read-char']               = read_char_proc
-        self['peek-char']               = peek_char_proc
-        self['input-port?']             = is_input_port_proc
-        self['open-input-file']         = open_input_file_proc
-        self['close-input-port']        = close_input_port_proc
-        self['eof-object?']             = is_eof_object_proc
-        self['write']                   = write_proc
-        self['write-char']              = write_char_proc
-        self['output-port?']            = is_output_port_proc
-        self['open-output-file']        = open_output_file_proc
-        self['close-output-port']       = close_output_port_proc
-        self['error']                   = error_proc
-
-global_env = Environment(None)
-global_env.populate()
-
-ungot = {}
+        primitive = self.define_primitive
+        primitive('null?',                   is_null_proc,                  1, 1)
+        primitive('boolean?',                is_boolean_proc,               1, 1)
+        primitive('symbol?',                 is_symbol_proc,                1, 1)
+        primitive('number?',                 is_number_proc,                1, 1)
+        primitive('complex?',                is_number_proc,                1, 1)
+        primitive('real?',                   is_number_proc,                1, 1)
+        primitive('rational?',               is_rational_proc,              1, 1)
+        primitive('integer?',                is_integer_proc,               1, 1)
+        primitive('exact?',                  is_exact_proc,                 1, 1)
+        primitive('inexact?',                is_inexact_proc,               1, 1)
+        primitive('char?',                   is_char_proc,                  1, 1)
+        primitive('string?',                 is_string_proc,                1, 1)
+        primitive('pair?',                   is_pair_proc,                  1, 1)
+        primitive('vector?',                 is_vector_proc,                1, 1)
+        primitive('procedure?',              is_procedure_proc,             1, 1)
+        primitive('char->integer',           char_to_integer_proc,          1, 1)
+        primitive('integer->char',           integer_to_char_proc,          1, 1)
+        primitive('number->string',          number_to_string_proc,         1, 2)
+        primitive('string->number',          string_to_number_proc,         1, 2)
+        primitive('symbol->string',          symbol_to_string_proc,         1, 1)
+        primitive('string->symbol',          string_to_symbol_proc,         1, 1)
+        primitive('make-string',             make_string_proc,              1, 2)
+        primitive('string',                  string_proc,                   0, None)
+        primitive('string-length',           string_length_proc,            1, 1)
+        primitive('string-ref',              string_ref_proc,               2, 2)
+        primitive('string-set!',             string_set_proc,               3, 3)
+        primitive('substring',               substring_proc,                3, 3)
+        primitive('string-append',           string_append_proc,            0, None)
+        primitive('string-append!',          string_append_bang_proc,       1, None)
+        primitive('string->list',            string_to_list_proc,           1, 1)
+        primitive('list->string',            list_to_string_proc,           1, 1)
+        primitive('string-copy',             string_copy_proc,              1, 1)
+        primitive('string-fill!',            string_fill_proc,              2, 2)
+        primitive('make-vector',             make_vector_proc,              1, 2)
+        primitive('vector',                  vector_proc,                   0, None)
+        primitive('vector-length',           vector_length_proc,            1, 1)
+        primitive('vector-ref',              vector_ref_proc,               2, 2)
+        primitive('vector-set!',             vector_set_proc,               3, 3)
+        primitive('vector->list',            vector_to_list_proc,           1, 1)
+        primitive('list->vector',            list_to_vector_proc,           1, 1)
+        primitive('vector-fill!',            vector_fill_proc,              2, 2)
+        primitive('make-f64vector',          make_f64vector_proc,           1, 2)
+        primitive('f64vector',               f64vector_proc,                0, None)
+        primitive('f64vector?',              is_f64vector_proc,             1, 1)
+        primitive('f64vector-length',        f64vector_length_proc,         1, 1)
+        primitive('f64vector-ref',           f64vector_ref_proc,            2, 2)
+        primitive('f64vector-set!',          f64vector_set_proc,            3, 3)
+        primitive('f64vector->list',         f64vector_to_list_proc,        1, 1)
+        primitive('list->f64vector',         list_to_f64vector_proc,        1, 1)
+        primitive('f64vector-copy',          f64vector_copy_proc,           1, 3)
+        primitive('f64vector-sum',           f64vector_sum_proc,            1, 1)
+        primitive('f64vector-dot',           f64vector_dot_proc,            2, 2)
+        primitive('+',                       add_proc,                      0, None)
+        primitive('-',                       sub_proc,                      1, None)
+        primitive('*',                       mul_proc,                      0, None)
+        primitive('/',                       div_proc,                      1, None)
+        primitive('quotient',                quotient_proc,                 2, 2)
+        primitive('remainder',               remainder_proc,                2, 2)
+        primitive('modulo',                  modulo_proc,                   2, 2)
+        primitive('=',                       is_equal_number_proc,          1, None)
+        primitive('<',                       is_less_than_proc,             1, None)
+        primitive('>',                       is_greater_than_proc,          1, None)
+        primitive('<=',                      is_less_or_equal_proc,         1, None)
+        primitive('>=',                      is_greater_or_equal_proc,      1, None)
+        primitive('zero?',                   is_zero_proc,                  1, 1)
+        primitive('positive?',               is_positive_proc,              1, 1)
+        primitive('negative?',               is_negative_proc,              1, 1)
+        primitive('odd?',                    is_odd_proc,                   1, 1)
+        primitive('even?',                   is_even_proc,                  1, 1)
+        primitive('max',                     max_proc,                      1, None)
+        primitive('min',                     min_proc,                      1, None)
+        primitive('abs',                     abs_proc,                      1, 1)
+        primitive('floor',                   floor_proc,                    1, 1)
+        primitive('ceiling',                 ceiling_proc,                  1, 1)
+        primitive('truncate',                truncate_proc,                 1, 1)
+        primitive('round',                   round_proc,                    1, 1)
+        primitive('exact->inexact',          exact_to_inexact_proc,         1, 1)
+        primitive('inexact->exact',          inexact_to_exact_proc,         1, 1)
+        primitive('sqrt',                    sqrt_proc,                     1, 1)
+        primitive('expt',                    expt_proc,                     2, 2)
+        primitive('cons',                    cons_proc,                     2, 2)
+        primitive('car',                     car_proc,                      1, 1)
+        primitive('cdr',                     cdr_proc,                      1, 1)
+        primitive('set-car!',                set_car_proc,                  2, 2)
+        primitive('set-cdr!',                set_cdr_proc,                  2, 2)
+        primitive('list',                    list_proc,                     0, None)
+        primitive('length',                  length_proc,                   1, 1)
+        primitive('append',                  append_proc,                   0, None)
+        primitive('reverse',                 reverse_proc,                  1, 1)
+        primitive('not',                     not_proc,                      1, 1)
+        primitive('eq?',                     is_eq_proc,                    2, None)
+        primitive('eqv?',                    is_eqv_proc,                   2, 2)
+        primitive('equal?',                  is_equal_proc,                 2, 2)
+        primitive('memq',                    memq_proc,                     2, 2)
+        primitive('memv',                    memv_proc,                     2, 2)
+        primitive('member',                  member_proc,                   2, 2)
+        primitive('assq',                    assq_proc,                     2, 2)
+        primitive('assv',                    assv_proc,                     2, 2)
+        primitive('assoc',                   assoc_proc,                    2, 2)
+        primitive('make-hash-table',         make_hash_table_proc,          0, 1)
+        primitive('hash-table?',             is_hash_table_proc,            1, 1)
+        primitive('hash-table-ref/default',  hash_table_ref_default_proc,   3, 3)
+        primitive('hash-table-set!',         hash_table_set_proc,           3, 3)
+        primitive('hash-table-delete!',      hash_table_delete_proc,        2, 2)
+        primitive('hash-table-exists?',      hash_table_exists_proc,        2, 2)
+        primitive('hash-table-count',        hash_table_count_proc,         1, 1)
+        primitive('hash-table-keys',         hash_table_keys_proc,          1, 1)
+        primitive('hash-table->alist',       hash_table_to_alist_proc,      1, 1)
+        primitive('interaction-environment', interaction_environment_proc,  0, 0)
+        primitive('null-environment',        null_environment_proc,         0, 1)
+        primitive('environment',             environment_proc,              0, 1)
+        primitive('load',                    load_proc,                     1, 1)
+        primitive('save-image',              save_image_proc,               1, 1)
+        primitive('read',                    read_proc,                     0, 1)
+        primitive('read-all',                read_all_proc,                 1, 1)
+        primitive('read-char',               read_char_proc,                0, 1)
+        primitive('peek-char',               peek_char_proc,                0, 1)
+        primitive('input-port?',             is_input_port_proc,            1, 1)
+        primitive('current-input-port',      current_input_port_proc,       0, 0)
+        primitive('open-input-file',         open_input_file_proc,          1, 1)
+        primitive('open-input-string',       open_input_string_proc,        1, 1)
+        primitive('close-input-port',        close_input_port_proc,         1, 1)
+        primitive('eof-object?',             is_eof_object_proc,            1, 1)
+        primitive('write',                   write_proc,                    1, 2)
+        primitive('display',                 display_proc,                  1, 2)
+        primitive('newline',                 newline_proc,                  0, 1)
+        primitive('write-char',              write_char_proc,               1, 2)
+        primitive('output-port?',            is_output_port_proc,           1, 1)
+        primitive('current-output-port',     current_output_port_proc,      0, 0)
+        primitive('open-output-file',        open_output_file_proc,         1, 2)
+        primitive('open-output-string',      open_output_string_proc,       0, 0)
+        primitive('get-output-string',       get_output_string_proc,        1, 1)
+        primitive('close-output-port',       close_output_port_proc,        1, 1)
+        primitive('flush-output-port',       flush_output_port_proc,        0, 1)
+        primitive('error',                   error_proc,                    0, None)
+        primitive('start-counters',          start_counters_proc,           0, 0)
+        primitive('stop-counters',           stop_counters_proc,            0, 0)
+        primitive('counters',                counters_proc,                 0, 0)
+        control = self.define_control
+        control('map',                            map_proc,             2, None)
+        control('for-each',                       for_each_proc,        2, None)
+        control('f64vector-map',                  f64vector_map_proc,   2, None)
+        control('hash-table-ref',                 hash_table_ref_proc,  2, 3)
+        control('hash-table-walk',                hash_table_walk_proc, 2, 2)
+        control('apply',                          apply_proc,           2, None)
+        control('eval',                           eval_proc,            2, 2)
+        control('call-with-current-continuation', call_cc_proc,         1, 1)
+        control('call/cc',                        call_cc_proc,         1, 1)
+        control('dynamic-wind',                   dynamic_wind_proc,    3, 3)
+        for name, func, min_args, max_args in math_procs:
+            primitive(name, make_math_proc(name, func), min_args, max_args)
+        for name, op in f64vector_ops:
+            primitive(name, make_f64vector_op_proc(name, op), 2, 2)
+        for suffix, test in string_comparisons:
+            for fold, infix in ((False, ''), (True, '-ci')):
+                name = 'string%s%s' % (infix, suffix)
+                primitive(name, make_string_compare_proc(name, test, fold),
+                          1, None)
+        for n in (2, 3, 4):
+            for path in itertools.product('ad', repeat=n):
+                name = 'c%sr' % ''.join(path)
+                primitive(name, make_cxr_proc(name), 1, 1)
+
+    def define_primitive(self, name, func, min_args, max_args):
+        self[Symbol(name)] = primitives[name] = Primitive(name, func,
+                                                          min_args, max_args)
+
+    def define_control(self, name, func, min_args, max_args):
+        self[Symbol(name)] = primitives[name] = Control(name, func,
+                                                        min_args, max_args)
+
+# Procedure calls don't create Environments.  The analyzer resolves each
+# local variable to a (depth, index) pair at analysis time, and a call
+# creates a Frame whose values list is indexed directly.  The chain of
+# Frames ends in the Environment the procedure was defined in, which is
+# only searched by name for global variables.
+
+class Frame(object):
+    __slots__ = ('values', 'parent')
+
+    def __init__(self, values, parent):
+        self.values = values
+        self.parent = parent
 
-def getc(f):
-    if f in ungot:
-        c = ungot[f]
-        del ungot[f]
-        return c
-    else:
-        return f.read(1) or EOF
+class Scope(object):
+    __slots__ = ('vars', 'parent', 'macros')
 
-def ungetc(f, c):
-    assert f not in ungot
-    ungot[f] = c
-    
-def peekc(f):
-    ungot[f] = c = getc(f)
-    return c
+    def __init__(self, vars, parent):
+        self.vars = vars
+        self.parent = parent
+        self.macros = {}
 
-def getc_or_die(f):
-    c = getc(f)
-    if c is EOF:
-        exit('Unexpected EOF')
-    return c
+# Hash tables
+#
+# A HashTable maps a Python key made from each Scheme key to a (key,
+# value) pair.  Most objects are their own key under eqv?: symbols,
+# pairs, strings and procedures hash by identity, and numbers and
+# characters by value.  Booleans, which Python would confuse with 0
+# and 1, and unhashable vectors and environments are keyed by id
+# instead, and floats, which Python would confuse with exact numbers,
+# by a tuple.  eq? tables share eqv? keys, as R5RS leaves eq? on
+# numbers and characters up to the implementation.
+#
+# Under equal?, a key that isn't a symbol, number or character is
+# wrapped in an EqualKey, which hashes at most equal_hash_limit nodes
+# of its structure, so that hashing a big tree takes constant time,
+# and compares with is_equal().  Keys must not be mutated while in a
+# table.
+
+def eqv_key(x):
+    if x.__class__ in identity_keyed:
+        return (id(x),)
+    if x.__class__ is float:
+        return (x,)
+    return x
+
+identity_keyed = set([bool, Vector, Environment])
+
+equal_hash_limit = 32
+
+def equal_hash(x):
+    h = 0
+    todo = [x]
+    for i in range(equal_hash_limit):
+        if not todo:
+            break
+        x = todo.pop()
+        if isinstance(x, Pair):
+            todo.append(x.cdr)
+            todo.append(x.car)
+            xh = 1
+        elif isinstance(x, Vector):
+            todo.extend(reversed(x[:equal_hash_limit]))
+            xh = 2
+        elif isinstance(x, String):
+            xh = hash(bytes(x.chars))
+        elif isinstance(x, F64Vector):
+            xh = hash(tuple(x.items[:equal_hash_limit]))
+        else:
+            xh = hash(eqv_key(x))
+        h = ((h * 1000003) ^ xh) & sys.maxsize
+    return h
+
+class EqualKey(object):
+    __slots__ = ('obj', 'hash')
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.hash = equal_hash(obj)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return other.__class__ is EqualKey and is_equal(self.obj, other.obj)
+
+def equal_key(x):
+    if x.__class__ in value_keyed:
+        return x
+    return EqualKey(x)
+
+value_keyed = set([Symbol, int, Fraction, Character])
+
+hash_table_keys = {
+    'eq?'     : eqv_key,
+    'eqv?'    : eqv_key,
+    'equal?'  : equal_key,
+    'string=?': equal_key,
+    }
+
+class HashTable(object):
+    __slots__ = ('equiv', 'key', 'entries')
+
+    def __init__(self, equiv, entries=()):
+        self.equiv = equiv
+        self.key = hash_table_keys[equiv]
+        self.entries = {}
+        for key, value in entries:
+            self.entries[self.key(key)] = key, value
+
+    def __reduce__(self):
+        # Keys made from ids don't survive pickling, so make new ones.
+        return HashTable, (self.equiv, list(self.entries.values()))
+
+def check_hash_table(obj, who):
+    if not isinstance(obj, HashTable):
+        exit('%s: not a hash table' % who)
+    return obj
+
+def make_hash_table_proc(equiv=None):
+    if equiv is None:
+        return HashTable('equal?')
+    if not isinstance(equiv, Primitive) or equiv.name not in hash_table_keys:
+        exit('make-hash-table: equivalence must be one of %s' %
+             ', '.join(sorted(hash_table_keys)))
+    return HashTable(equiv.name)
+
+def is_hash_table_proc(obj):
+    return isinstance(obj, HashTable)
+
+def hash_table_ref_default_proc(table, key, default):
+    table = check_hash_table(table, 'hash-table-ref/default')
+    entry = table.entries.get(table.key(key))
+    return default if entry is None else entry[1]
+
+def hash_table_set_proc(table, key, value):
+    table = check_hash_table(table, 'hash-table-set!')
+    table.entries[table.key(key)] = key, value
+    return Symbol('ok')
 
+def hash_table_delete_proc(table, key):
+    table = check_hash_table(table, 'hash-table-delete!')
+    table.entries.pop(table.key(key), None)
+    return Symbol('ok')
 
-def is_digit(c):
-    return c in string.digits
+def hash_table_exists_proc(table, key):
+    table = check_hash_table(table, 'hash-table-exists?')
+    return table.key(key) in table.entries
 
-def is_space(c):
-    return c in string.whitespace
+def hash_table_count_proc(table):
+    return len(check_hash_table(table, 'hash-table-count').entries)
 
-def is_delimiter(c):
-    return not c or c in '()"' or is_space(c);
+def hash_table_keys_proc(table):
+    table = check_hash_table(table, 'hash-table-keys')
+    return scheme_list([key for key, value in table.entries.values()])
 
-def is_initial(c):
-    return c in string.ascii_letters or c in '!$%&*:<=>?^_~'
+def hash_table_to_alist_proc(table):
+    table = check_hash_table(table, 'hash-table->alist')
+    return scheme_list([cons(key, value)
+                        for key, value in table.entries.values()])
 
-def is_subsequent(c):
-    return (c is not EOF and (is_initial(c) or is_digit(c) or c in '+-.@'))
+# Reader
+#
+# An InputPort reads its file a chunk at a time (a line at a time when
+# interactive) and tokenizes the buffer with one regular expression,
+# which skips leading whitespace and names the token kind by its group.
+# When a match runs into the end of the buffer, or finds no token, the
+# port reads more input and matches again, so tokens may straddle chunk
+# boundaries.  The port tracks line and column for error messages.
+#
+# Regular files are memory-mapped instead: the whole mapping is the
+# buffer, the regex scans it in place, and only the text of each token
+# is copied out.  Either way the buffer holds bytes, and a token's text
+# is decoded as Latin-1, so every byte is a character.
+
+delimiter = r'(?=[\s()";]|\Z)'
+initial = r'a-zA-Z!$%&*/:<=>?^_~'
+subsequent = initial + r'0-9+\-.@'
+
+token_re = re.compile((r"""
+    (?:\s+|;[^\n]*)*             # whitespace and comments
+  (?:
+    (?P<number>     (?:%(number_pattern)s) %(delimiter)s )
+  | (?P<badnumber>  [+-]?\.?[0-9] )
+  | (?P<symbol>     [%(initial)s][%(subsequent)s]*
+                  | [+-] %(delimiter)s
+                  | [+-]>[%(subsequent)s]*
+                  | \.\.\. %(delimiter)s )
+  | (?P<f64vector>  \#f64\( )
+  | (?P<boolean>    \#[tTfF] )
+  | (?P<vector>     \#\( )
+  | (?P<character>  \#\\(?:[a-z]+|.) )
+  | (?P<string>     "(?:[^"\\]|\\.)*" )
+  | (?P<open>       \( )
+  | (?P<close>      \) )
+  | (?P<dot>        \. %(delimiter)s )
+  | (?P<quote>      ' )
+  )?
+""" % locals()).encode('latin-1'), re.VERBOSE | re.DOTALL)
+escape_re = re.compile(r'\\(.)', re.DOTALL)
+
+class InputPort(object):
+
+    chunk_size = 65536
+
+    def __init__(self, f, name=None, buffer=None):
+        self.file = f
+        self.name = name or getattr(f, 'name', '<port>')
+        self.interactive = buffer is None and f.isatty()
+        self.buffer = b'' if buffer is None else buffer
+        self.pos = 0
+        self.line = 1           # line and column of buffer[0]
+        self.column = 1
+        self.located = 0, 1, 1  # a position and its line and column
+        self.weak_symbols = False
+        self.at_eof = buffer is not None
+
+    def fill(self):
+        if self.at_eof:
+            return False
+        # Show pending output before waiting for the input that may
+        # answer it, as C stdio does; this covers read, read-char and
+        # peek-char on the current input port.
+        if self is stdin_port:
+            stdout_port.flush()
+        # read1 returns what one read gets, so input from a pipe is
+        # handled as it arrives rather than once a chunk has built up.
+        if self.interactive:
+            data = self.file.readline()
+        else:
+            data = self.file.read1(self.chunk_size)
+        if not data:
+            self.at_eof = True
+            return False
+        self.line, self.column = self.location()
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        self.located = 0, self.line, self.column
+        return True
+
+    def location(self):
+        # Count from the last position located, so that locating every
+        # list while profiling takes linear time.
+        start, line, column = self.located
+        if start > self.pos:
+            start, line, column = 0, self.line, self.column
+        consumed = self.buffer[start:self.pos]
+        newlines = consumed.count(b'\n')
+        if newlines:
+            line += newlines
+            column = len(consumed) - consumed.rfind(b'\n')
+        else:
+            column += len(consumed)
+        self.located = self.pos, line, column
+        return line, column
+
+    def error(self, msg):
+        line, column = self.location()
+        exit('%s:%d:%d: %s' % (self.name, line, column, msg))
+
+    def token(self):
+        m = token_re.match(self.buffer, self.pos)
+        while ((m.lastgroup is None or m.end() == len(self.buffer))
+               and self.fill()):
+            m = token_re.match(self.buffer, self.pos)
+        kind = m.lastgroup
+        if kind is None:
+            self.pos = m.end()
+            if self.pos == len(self.buffer):
+                return None, EOF
+            self.error('bad input.  Unexpected "%s"' %
+                       characters[self.buffer[self.pos]])
+        if kind == 'badnumber':
+            self.pos = m.start(kind)
+            self.error('number not followed by delimiter')
+        self.pos = m.end()
+        return kind, m.group(kind).decode('latin-1')
+
+    def getc(self):
+        if self.pos == len(self.buffer) and not self.fill():
+            return EOF
+        c = characters[self.buffer[self.pos]]
+        self.pos += 1
+        return c
 
-def eat_whitespace(f):
+    def peekc(self):
+        if self.pos == len(self.buffer) and not self.fill():
+            return EOF
+        return characters[self.buffer[self.pos]]
+
+    def __reduce__(self):
+        raise TypeError("can't save a port")
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+stdin_port = InputPort(sys.stdin.buffer)
+
+def open_input_port(fname):
+    f = open(fname, 'rb')
+    name = os.fsdecode(fname)
+    try:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        # Empty files, pipes and devices can't be mapped.
+        return InputPort(f, name)
+    return InputPort(f, name, buffer)
+
+def read_character(port, token):
+    name = token[2:]
+    if len(name) > 1:
+        if name not in Character.name_to_char:
+            port.error('illegal character "#\\%s"' % name)
+        return Character(Character.name_to_char[name])
+    return Character(name)
+
+def read_number(port, token):
+    try:
+        return parse_number(token)
+    except ValueError as e:
+        port.error(str(e))
+
+def read_string(port, token):
+    s = token[1:-1]
+    if '\\' in s:
+        s = escape_re.sub(lambda m: String.escape_to_char.get(m.group(1),
+                                                              m.group(1)),
+                          s)
+    return String(s)
+
+def read_list(port, token):
+    if profiler is not None:
+        source = port.name, port.location()[0]
+    items = []
     while True:
-        c = getc(f)
-        if c is EOF:
-            ungetc(f, c)
+        kind, token = port.token()
+        if kind == 'close':
+            tail = None
             break
-        if c == ';':
-            while c and c != '\n':
-                c = getc(f)
-            continue
-        if not is_space(c):
-            ungetc(f, c)
+        if kind == 'dot' and items:
+            tail = read_or_die(port)
+            if port.token()[0] != 'close':
+                port.error('expected ")"')
             break
+        items.append(read_datum(port, kind, token))
+    for item in reversed(items):
+        tail = cons(item, tail)
+    if profiler is not None and tail is not None:
+        profiler.locations[tail] = source
+    return tail
+
+def read_vector(port, token):
+    items = Vector()
+    while True:
+        kind, token = port.token()
+        if kind == 'close':
+            return items
+        items.append(read_datum(port, kind, token))
 
-def read_character(f):
-    c = getc_or_die(f)
-    if c in string.ascii_lowercase:
-        s = ''
-        while c in string.ascii_lowercase:
-            s += c
-            c = getc(f)
-        ungetc(f, c)
-        if len(s) > 1:
-            if s in Character.name_to_char:
-                return Character(Character.name_to_char[s])
-            else:
-                exit('illegal character "#\%s"' % s)
-        c = s
-    return Character(c)
-
-def read_string(f):
-    s = ''
+def read_f64vector(port, token):
+    items = []
     while True:
-        c = getc_or_die(f)
-        if c == '"':
-            return String(s)
-        elif c == '\\':
-            c = getc_or_die(f)
-            c = String.escape_to_char.get(c, c)
-        s += c
-
-def read_pair(f):
-    eat_whitespace(f)
-    c = getc_or_die(f)
-    if c == ')':
-        return None
-    ungetc(f, c)
-    car_obj = read_or_die(f)
-    eat_whitespace(f)
-    c = getc_or_die(f)
-    if c == '.':
-        c = peekc(f)
-        if not is_delimiter(c):
-            exit('dot not followed by delimiter')
-        eat_whitespace(f)
-        cdr_obj = read_or_die(f)
-        eat_whitespace(f)
-        c = getc_or_die(f)
-        if c != ')':
-            exit('expected ")", got "%s"' % c)
-    else:
-        ungetc(f, c)
-        cdr_obj = read_pair(f)
-    return cons(car_obj, cdr_obj)
-
-def read_or_die(f):
-    exp = read(f)
-    if exp is EOF:
-        exit('unexpected EOF')
-    return exp
-
-def read(f):
-    sign = 1
+        kind, token = port.token()
+        if kind == 'close':
+            return F64Vector(items)
+        z = read_datum(port, kind, token)
+        if not is_number(z):
+            port.error('f64vector element is not a real number')
+        try:
+            items.append(float(z))
+        except OverflowError:
+            port.error('f64vector element is too large')
+
+def read_quotation(port, token):
+    return cons(Symbol('quote'), cons(read_or_die(port), None))
+
+def read_unexpected(port, token):
+    port.error('bad input.  Unexpected "%s"' % token)
+
+datum_readers = {
+    'number'   : read_number,
+    'symbol'   : lambda port, token: Symbol(token, port.weak_symbols),
+    'boolean'  : lambda port, token: token[1] in 'tT',
+    'character': read_character,
+    'string'   : read_string,
+    'open'     : read_list,
+    'vector'   : read_vector,
+    'f64vector': read_f64vector,
+    'quote'    : read_quotation,
+    'close'    : read_unexpected,
+    'dot'      : read_unexpected,
+    }
+
+def read_datum(port, kind, token):
+    if kind is None:
+        port.error('unexpected EOF')
+    return datum_readers[kind](port, token)
+
+def read_or_die(port):
+    return read_datum(port, *port.token())
+
+def read(port, weak_symbols=False):
+    kind, token = port.token()
+    if kind is None:
+        return EOF
+    port.weak_symbols = weak_symbols
+    return read_datum(port, kind, token)
+
+def read_forms(port, weak_symbols=False):
     while True:
-        eat_whitespace(f)
-        c = getc(f)
-        if c is EOF:
-            return EOF
-        if (c == '-' and is_digit(peekc(f))) or is_digit(c):
-            if c == '-':
-                sign = -1
-                c = getc_or_die(f)
+        exp = read(port, weak_symbols)
+        if exp is EOF:
+            return
+        yield exp
+
+# Load cache
+#
+# load saves the forms it reads from a file in a cache file beside it
+# ("lib.scm" -> "lib.scmc"), and a later load of the unchanged file
+# reads the forms from there instead of parsing the source.  The cache
+# starts with a key of the source's mtime, size and SHA-1 digest; if
+# any of them differ, the source is parsed again and the cache
+# replaced.  Only the reader's output is cached, since what a form
+# analyzes to depends on the macros and definitions in effect when it
+# is loaded.
+#
+# The cache is written as the source is read, one marshal record per
+# form, and read back a form at a time, so that neither holds more
+# than one form in memory.  A form is stored as a flat sequence of
+# items in postfix order, which decode_datum() rebuilds with a stack:
+# a byte string of tags, one per item, and a tuple of the items'
+# arguments.  Symbols are stored as indices into a symbol table kept
+# for the whole file, whose names are written once, at the end of the
+# record of the form that first uses each.  The commonest items need no
+# argument: a proper list of fewer than 48 items has its length in its
+# tag, and a symbol among the file's first 192 has its index there.
+
+cache_magic = 'pyscheme-forms-4'
+
+(TAG_SYMBOL, TAG_ATOM, TAG_STRING, TAG_CHARACTER, TAG_FRACTION,
+ TAG_F64VECTOR, TAG_LIST, TAG_DOTTED, TAG_VECTOR) = range(9)
+TAG_SHORT_LIST = 16             # + the length of the list
+TAG_SHORT_SYMBOL = 64           # + the index of the symbol
+
+class FormEncoder(object):
+
+    def __init__(self):
+        self.symbols = {}       # name -> index in the file's table
+
+    def encode(self, exp):
+        self.names = []
+        self.tags = bytearray()
+        self.args = []
+        self.add(exp)
+        if self.names:
+            return bytes(self.tags), tuple(self.args), self.names
+        return bytes(self.tags), tuple(self.args)
+
+    def add(self, x):
+        tags, args = self.tags, self.args
+        if isinstance(x, Pair):
             n = 0
-            while is_digit(c):
-                n = 10 * n + ord(c) - ord('0')
-                c = getc(f)
-            n *= sign
-            if is_delimiter(c):
-                ungetc(f, c)
-                return int(n)
-            exit('number not followed by delimiter')
-        elif is_initial(c) or (c in '+-' and
-                               (is_delimiter(peekc(f)) or peekc(f) == '>')):
-            sym = c
-            while is_subsequent(peekc(f)):
-                sym += getc(f)
-            return Symbol(sym)
-        elif c == '#':
-            c = getc_or_die(f)
-            if c.lower() == 'f':
-                return False
-            elif c.lower() == 't':
-                return True
-            elif c == '\\':
-                return read_character(f)
+            while isinstance(x, Pair):
+                self.add(x.car)
+                x = x.cdr
+                n += 1
+            if x is not None:
+                self.add(x)
+                tags.append(TAG_DOTTED)
+                args.append(n)
+            elif n < TAG_SHORT_SYMBOL - TAG_SHORT_LIST:
+                tags.append(TAG_SHORT_LIST + n)
             else:
-                exit('bad input.  Unexpected "#%s"' % c)
-        elif c == '"':
-            return read_string(f)
-        elif c == '(':
-            return read_pair(f)
-        elif c == "'":
-            return cons(Symbol('quote'), cons(read(f), None))
+                tags.append(TAG_LIST)
+                args.append(n)
+        elif isinstance(x, Symbol):
+            index = self.symbols.get(x.name)
+            if index is None:
+                index = self.symbols[x.name] = len(self.symbols)
+                self.names.append(x.name)
+            if index < 256 - TAG_SHORT_SYMBOL:
+                tags.append(TAG_SHORT_SYMBOL + index)
+            else:
+                tags.append(TAG_SYMBOL)
+                args.append(index)
+        elif isinstance(x, String):
+            tags.append(TAG_STRING)
+            args.append(str(x))
+        elif isinstance(x, Vector):
+            for item in x:
+                self.add(item)
+            tags.append(TAG_VECTOR)
+            args.append(len(x))
+        elif isinstance(x, Fraction):
+            tags.append(TAG_FRACTION)
+            args.append((x.numerator, x.denominator))
+        elif isinstance(x, F64Vector):
+            tags.append(TAG_F64VECTOR)
+            args.append(x.items.tobytes())
+        elif isinstance(x, Character):
+            tags.append(TAG_CHARACTER)
+            args.append(str(x))
+        else:
+            tags.append(TAG_ATOM)
+            args.append(x)
+
+def decode_datum(form, symbols):
+    tags, args = form[:2]
+    if len(form) > 2:
+        table = Symbol.all
+        for name in form[2]:
+            symbols.append(table.get(name) or Symbol(name))
+    stack = []
+    i = 0
+    for tag in tags:
+        if tag >= TAG_SHORT_SYMBOL:
+            stack.append(symbols[tag - TAG_SHORT_SYMBOL])
+            continue
+        elif tag >= TAG_SHORT_LIST:
+            n = tag - TAG_SHORT_LIST
+            tail = None
+        elif tag == TAG_SYMBOL:
+            stack.append(symbols[args[i]])
+            i += 1
+            continue
+        elif tag == TAG_ATOM:
+            stack.append(args[i])
+            i += 1
+            continue
+        elif tag == TAG_LIST or tag == TAG_DOTTED:
+            n = args[i]
+            i += 1
+            tail = None if tag == TAG_LIST else stack.pop()
+        elif tag == TAG_VECTOR:
+            n = len(stack) - args[i]
+            i += 1
+            vector = Vector(stack[n:])
+            del stack[n:]
+            stack.append(vector)
+            continue
         else:
-            exit('bad input.  Unexpected "%s"' % c)
-        
+            arg = args[i]
+            i += 1
+            if tag == TAG_STRING:
+                stack.append(String(arg))
+            elif tag == TAG_CHARACTER:
+                stack.append(characters[ord(arg)])
+            elif tag == TAG_FRACTION:
+                stack.append(Fraction(*arg))
+            else:
+                items = array.array('d')
+                items.frombytes(arg)
+                stack.append(F64Vector(items))
+            continue
+        n = len(stack) - n
+        for item in reversed(stack[n:]):
+            tail = Pair(item, tail)
+        del stack[n:]
+        stack.append(tail)
+    return stack[0]
+
+def cache_key(fname):
+    st = os.stat(fname)
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return cache_magic, st.st_mtime, st.st_size, digest.hexdigest()
+
+def open_cache(fname, key):
+    # The cache file, positioned after its key, or None if there's no
+    # cache for this version of the source.
+    try:
+        f = open(fname + b'c', 'rb')
+    except EnvironmentError:
+        return None
+    try:
+        if marshal.load(f) == key:
+            return f
+    except (EOFError, ValueError, TypeError):
+        pass
+    f.close()
+    return None
+
+def cached_forms(f, fname):
+    symbols = []
+    with f:
+        while True:
+            try:
+                form = marshal.load(f)
+            except EOFError:
+                return
+            except (ValueError, TypeError):
+                exit('load: %sc: bad cache file' % os.fsdecode(fname))
+            yield decode_datum(form, symbols)
+
+class CacheWriter(object):
+    # Writes a temporary file and renames it when the whole source has
+    # been read, so that concurrent interpreters never read a partly
+    # written cache, and a load that fails leaves no cache behind.
+
+    def __init__(self, fname, key):
+        self.cache = fname + b'c'
+        self.temp = b'%s.%d' % (self.cache, os.getpid())
+        self.encoder = FormEncoder()
+        try:
+            self.file = open(self.temp, 'wb')
+            marshal.dump(key, self.file)
+        except EnvironmentError:
+            self.file = None
+
+    def write(self, exp):
+        if self.file is not None:
+            try:
+                marshal.dump(self.encoder.encode(exp), self.file)
+            except EnvironmentError:
+                self.abandon()
+
+    def abandon(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        try:
+            os.remove(self.temp)
+        except EnvironmentError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.file is None:
+            return
+        if exc_type is not None:
+            self.abandon()
+            return
+        try:
+            self.file.close()
+            self.file = None
+            os.rename(self.temp, self.cache)
+        except EnvironmentError:
+            self.abandon()
+
+# Images
+#
+# save-image pickles the global environment, and with it every
+# procedure, macro and datum reachable from it, along with the symbol
+# table.  "scheme.py --image FILE" starts from that environment instead
+# of a freshly populated one.  Primitives are pickled by name, so an
+# image uses the primitives of the interpreter that loads it.
+#
+# Pickling recurses into each object's contents, and Python 3.12 caps
+# that recursion however big the stack, so ImagePickler doesn't pickle
+# a list as nested pairs.  The first pair it pickles of a list has as
+# its cdr a PairChain holding the rest of its pairs in a Python list,
+# which pickle saves one after another, each with only its car;
+# unpickling the chain calls join_pairs() to link them up again.  Other
+# structure still recurses, so pickling runs in a thread whose stack is
+# big enough for deep trees.  Ports can't be saved: their __reduce__
+# raises TypeError, since the files and mmaps behind them couldn't be
+# loaded again.
+
+image_magic = 'pyscheme-image-3'
+image_stack_size = 512 * 1024 * 1024
+
+class PairChain(object):
+    __slots__ = ('pairs', 'tail')
+
+    def __init__(self, pairs, tail):
+        self.pairs = pairs
+        self.tail = tail
+
+    def __reduce__(self):
+        return join_pairs, (self.pairs, self.tail)
+
+def join_pairs(pairs, tail):
+    for pair, cdr in zip(pairs, pairs[1:]):
+        pair.cdr = cdr
+    pairs[-1].cdr = tail
+    return pairs[0]
+
+# Pairs are reduced through dispatch_table rather than reducer_override,
+# which needs Python 3.8.
+class ImagePickler(pickle.Pickler):
+
+    def __init__(self, f):
+        pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+        self.dispatch_table = {Pair: self.reduce_pair}
+        self.linked = set()     # ids of pairs a chain will link up
+
+    def reduce_pair(self, pair):
+        if id(pair) in self.linked:
+            return Pair, (None, None), (None, {'car': pair.car})
+        pairs = []
+        seen = set([id(pair)])
+        tail = pair.cdr
+        while isinstance(tail, Pair) and id(tail) not in seen:
+            seen.add(id(tail))
+            pairs.append(tail)
+            tail = tail.cdr
+        if not pairs:
+            return Pair, (None, None), (None, {'car': pair.car,
+                                               'cdr': tail})
+        self.linked.update(map(id, pairs))
+        return Pair, (None, None), (None, {'car': pair.car,
+                                           'cdr': PairChain(pairs, tail)})
+
+def save_image_proc(fname):
+    fname = check_path(fname, 'save-image')
+    result = []
+    def dump():
+        try:
+            f = io.BytesIO()
+            ImagePickler(f).dump((image_magic, list(Symbol.all),
+                                  global_env))
+            result.append(f.getvalue())
+        except (pickle.PicklingError, TypeError, AttributeError,
+                RecursionError) as e:
+            result.append(e)
+    limit = sys.getrecursionlimit()
+    stack_size = threading.stack_size(image_stack_size)
+    sys.setrecursionlimit(1000000)
+    try:
+        thread = threading.Thread(target=dump)
+        thread.start()
+        thread.join()
+    finally:
+        sys.setrecursionlimit(limit)
+        threading.stack_size(stack_size)
+    if not isinstance(result[0], bytes):
+        exit('save-image: %s' % result[0])
+    try:
+        with open(fname, 'wb') as f:
+            f.write(result[0])
+    except EnvironmentError as e:
+        exit('save-image: %s: %s' % (os.fsdecode(fname), e.strerror))
+    return Symbol('ok')
+
+def load_image(fname):
+    global global_env
+    try:
+        with open(fname, 'rb') as f:
+            image = pickle.load(f)
+    except EnvironmentError as e:
+        exit('%s: %s' % (fname, e.strerror))
+    except (pickle.UnpicklingError, EOFError, ValueError,
+            AttributeError, ImportError, IndexError):
+        image = None
+    if not isinstance(image, tuple) or image[0] != image_magic:
+        exit('%s: not a pyscheme image' % fname)
+    magic, symbols, global_env = image
+    for name in symbols:
+        Symbol(name)
 
 def is_self_evaluating(exp):
-    return isinstance(exp, (int, long, bool, Character, String))
+    return isinstance(exp, (int, Fraction, float, bool, Character,
+                            String, Vector, F64Vector))
 
 def is_variable(exp):
     return isinstance(exp, Symbol)
@@ -594,49 +2159,13 @@ def tagged_list_predicate(sym):
     sym = Symbol(sym)    
     return lambda exp: isinstance(exp, Pair) and car(exp) is sym
 
-is_quotation  = tagged_list_predicate('quote')
 is_definition = tagged_list_predicate('define')
-is_assignment = tagged_list_predicate('set!')
-is_if         = tagged_list_predicate('if')
 is_lambda     = tagged_list_predicate('lambda')
 is_begin      = tagged_list_predicate('begin')
-is_cond       = tagged_list_predicate('cond')
-is_let        = tagged_list_predicate('let')
-is_and        = tagged_list_predicate('and')
-is_or         = tagged_list_predicate('or')
-
-def is_true(exp):
-    return exp is not False
-
-def is_false(exp):
-    return exp is False
 
 def is_application(exp):
     return isinstance(exp, Pair)
 
-def eval_variable(exp, env):
-    return env[exp]
-
-def eval_quotation(exp, env):
-    return cadr(exp)
-
-def eval_definition(exp, env):
-    var = cadr(exp)
-    if isinstance(var, Pair):
-        var, params = car(var), cdr(var)
-        value = make_compound_proc(params, cddr(exp), env)
-    else:
-        value = scheval(caddr(exp), env)
-    env[var] = value
-    return Symbol('ok')
-
-def eval_assignment(exp, env):
-    env.set_variable(cadr(exp), scheval(caddr(exp), env))
-    return Symbol('ok')
-
-def eval_lambda(exp, env):
-    return make_compound_proc(cadr(exp), cddr(exp), env)
-
 def cond_to_if(exp):
 
     def make_if(predicate, consequent, alternative):
@@ -647,6 +2176,9 @@ def cond_to_if(exp):
 
     is_cond_else_clause = tagged_list_predicate('else')
 
+    def make_begin(seq):
+        return cons(Symbol('begin'), seq)
+
     def sequence_to_exp(seq):
         if seq is None:
             return None
@@ -701,151 +2233,1727 @@ def let_to_application(exp):
                                         let_body(exp)),
                             let_arguments(exp))
 
-def apply_operands(args):
-    def prepare_apply_operands(args):
-        if cdr(args) is None:
-            return car(args)
-        return cons(car(args), prepare_apply_operands(cdr(args)))
-    return prepare_apply_operands(cdr(args))
+def gensym(name):
+    # Uninterned, so these can't collide with variables in the source,
+    # even ones made by string->symbol, and go away with the code that
+    # uses them.
+    gensym.counter += 1
+    return uninterned_symbol('#:%s%d' % (name, gensym.counter))
+gensym.counter = 0
+
+def let_star_to_let(exp):
+    bindings, body = cadr(exp), cddr(exp)
+    if bindings is None or cdr(bindings) is None:
+        return cons(Symbol('let'), cons(bindings, body))
+    return scheme_list([Symbol('let'),
+                        scheme_list([car(bindings)]),
+                        cons(Symbol('let*'), cons(cdr(bindings), body))])
+
+def letrec_to_let(exp):
+    defines = [cons(Symbol('define'), binding)
+               for binding in python_list(cadr(exp), 'letrec')]
+    body = scheme_list([cons(Symbol('let'), cons(None, cddr(exp)))])
+    return cons(Symbol('let'), cons(None, scheme_list(defines, body)))
+
+def named_let_to_letrec(exp):
+    name, bindings, body = cadr(exp), caddr(exp), cdddr(exp)
+    bindings = python_list(bindings, 'let')
+    params = scheme_list([car(b) for b in bindings])
+    args = scheme_list([cadr(b) for b in bindings])
+    proc = cons(Symbol('lambda'), cons(params, body))
+    letrec = scheme_list([Symbol('letrec'),
+                          scheme_list([scheme_list([name, proc])]),
+                          name])
+    return cons(letrec, args)
+
+def case_to_cond(exp):
+    key = gensym('key')
+    clauses = []
+    for clause in python_list(cddr(exp), 'case'):
+        data = car(clause)
+        if data is not Symbol('else'):
+            data = scheme_list([Symbol('memv'), key,
+                                scheme_list([Symbol('quote'), data])])
+        clauses.append(cons(data, cdr(clause)))
+    return scheme_list([Symbol('let'),
+                        scheme_list([scheme_list([key, cadr(exp)])]),
+                        cons(Symbol('cond'), scheme_list(clauses))])
+
+def do_to_named_let(exp):
+    loop = gensym('do')
+    specs = python_list(cadr(exp), 'do')
+    test, results = car(caddr(exp)), cdr(caddr(exp))
+    commands = cdddr(exp)
+    bindings = scheme_list([scheme_list([car(s), cadr(s)]) for s in specs])
+    steps = [caddr(s) if cddr(s) is not None else car(s) for s in specs]
+    repeat = scheme_list(python_list(commands, 'do') +
+                         [cons(loop, scheme_list(steps))])
+    return scheme_list([Symbol('let'), loop, bindings,
+                        scheme_list([Symbol('if'), test,
+                                     cons(Symbol('begin'),
+                                          cons(False, results)),
+                                     cons(Symbol('begin'), repeat)])])
+
+# Macros
+#
+# define-syntax binds a keyword to a syntax-rules Macro.  Macro uses are
+# expanded by the analyzer, so each use is expanded once, when the code
+# containing it is analyzed, and never at run time.  Macros are not
+# hygienic: a template's free symbols mean whatever they mean where the
+# macro is used.
 
-def list_of_values(exp, env):
-    if exp is None:
-        return None
-    return cons(scheval(car(exp), env), list_of_values(cdr(exp), env))
+ellipsis = Symbol('...')
+underscore = Symbol('_')
 
-def scheval(exp, env):
-    while True:
-        if is_self_evaluating(exp):
-            return exp
-        elif is_variable(exp):
-            return eval_variable(exp, env)
-        elif is_quotation(exp):
-            return eval_quotation(exp, env)
-        elif is_definition(exp):
-            return eval_definition(exp, env)
-        elif is_assignment(exp):
-            return eval_assignment(exp, env)
-        elif is_if(exp):
-            if is_true(scheval(cadr(exp), env)):
-                exp = caddr(exp)
-                continue
-            elif isinstance(cdddr(exp), Pair):
-                exp = cadddr(exp)
-                continue
+# The matches of a pattern variable that is followed by an ellipsis.
+class Repeated(list):
+    pass
+
+class Macro(object):
+    __slots__ = ('name', 'literals', 'rules')
+
+    def __init__(self, name, spec):
+        if not (isinstance(spec, Pair) and spec.car is Symbol('syntax-rules')):
+            exit('define-syntax: %s: expected syntax-rules' % name)
+        self.name = name
+        self.literals = python_list(cadr(spec), 'syntax-rules')
+        self.rules = [(car(rule), cadr(rule))
+                      for rule in python_list(cddr(spec), 'syntax-rules')]
+
+    def expand(self, exp):
+        for pattern, template in self.rules:
+            bindings = {}
+            if self.match(cdr(pattern), cdr(exp), bindings):
+                return instantiate(template, bindings)
+        exit('%s: no syntax rule matches' % self.name)
+
+    def match(self, pattern, form, bindings):
+        if isinstance(pattern, Symbol):
+            if pattern in self.literals:
+                return form is pattern
+            if pattern is not underscore:
+                bindings[pattern] = form
+            return True
+        if isinstance(pattern, Pair):
+            if isinstance(pattern.cdr, Pair) and pattern.cdr.car is ellipsis:
+                return self.match_repeated(pattern.car, pattern.cdr.cdr,
+                                           form, bindings)
+            return (isinstance(form, Pair) and
+                    self.match(pattern.car, form.car, bindings) and
+                    self.match(pattern.cdr, form.cdr, bindings))
+        if pattern is None:
+            return form is None
+        return is_equal(pattern, form)
+
+    def match_repeated(self, pattern, rest, form, bindings):
+        # Match pattern against as many elements of form as possible
+        # while leaving enough for the patterns in rest.
+        items = []
+        while isinstance(form, Pair):
+            items.append(form.car)
+            form = form.cdr
+        pattern_rest, min_rest = rest, 0
+        while isinstance(rest, Pair):
+            min_rest += 1
+            rest = rest.cdr
+        n = len(items) - min_rest
+        if n < 0:
             return False
-        elif is_lambda(exp):
-            return eval_lambda(exp, env)
-        elif is_begin(exp):
-            exp = cdr(exp)
-            while cdr(exp) is not None:
-                scheval(car(exp), env)
-                exp = cdr(exp)
-            exp = car(exp)
-            continue
-        elif is_cond(exp):
-            exp = cond_to_if(exp)
-            continue
-        elif is_let(exp):
-            exp = let_to_application(exp)
-            continue
-        elif is_and(exp):
-            exp = cdr(exp)
-            if exp is None:
-                return True
-            while cdr(exp) is not None:
-                result = scheval(car(exp), env)
-                if is_false(result):
-                    return result
-                exp = cdr(exp)
-            exp = car(exp)
-            continue
-        elif is_or(exp):
-            exp = cdr(exp)
-            if exp is None:
+        matches = []
+        for item in items[:n]:
+            b = {}
+            if not self.match(pattern, item, b):
                 return False
-            while cdr(exp) is not None:
-                result = scheval(car(exp), env)
-                if is_true(result):
-                    return result
-                exp = cdr(exp)
-            exp = car(exp)
-            continue
-        elif is_application(exp):
-            proc = scheval(car(exp), env)
-            args = list_of_values(cdr(exp), env)
-            if proc is eval_proc:
-                exp = car(args)
-                env = cadr(args)
+            matches.append(b)
+        for var in pattern_variables(pattern, self.literals):
+            bindings[var] = Repeated(b[var] for b in matches)
+        return self.match(pattern_rest, scheme_list(items[n:], form), bindings)
+
+def pattern_variables(pattern, literals):
+    if isinstance(pattern, Symbol):
+        if pattern in literals or pattern in (underscore, ellipsis):
+            return []
+        return [pattern]
+    if isinstance(pattern, Pair):
+        return (pattern_variables(pattern.car, literals) +
+                pattern_variables(pattern.cdr, literals))
+    return []
+
+def instantiate(template, bindings):
+    if isinstance(template, Symbol):
+        return bindings.get(template, template)
+    if not isinstance(template, Pair):
+        return template
+    if isinstance(template.cdr, Pair) and template.cdr.car is ellipsis:
+        sub = template.car
+        vars = [var for var in pattern_variables(sub, ())
+                if isinstance(bindings.get(var), Repeated)]
+        if not vars:
+            exit('syntax-rules: no pattern variable before ...')
+        lengths = set(len(bindings[var]) for var in vars)
+        if len(lengths) != 1:
+            exit('syntax-rules: mismatched ... lengths')
+        results = []
+        for i in range(lengths.pop()):
+            b = dict(bindings)
+            for var in vars:
+                b[var] = bindings[var][i]
+            results.append(instantiate(sub, b))
+        return scheme_list(results, instantiate(template.cdr.cdr, bindings))
+    return cons(instantiate(template.car, bindings),
+                instantiate(template.cdr, bindings))
+
+def lookup_macro(name, scope):
+    while isinstance(scope, Scope):
+        if name in scope.vars:
+            return None
+        if name in scope.macros:
+            return scope.macros[name]
+        scope = scope.parent
+    macro = scope.get(name)
+    return macro if isinstance(macro, Macro) else None
+
+def analyze_define_syntax(exp, scope):
+    name = cadr(exp)
+    macro = Macro(name, caddr(exp))
+    if isinstance(scope, Scope):
+        scope.macros[name] = macro
+    else:
+        scope[name] = macro
+    return Constant(Symbol('ok'))
+
+# Analyzer
+#
+# analyze() walks an expression once and turns it into a tree of nodes,
+# which execute() runs as a machine with an explicit continuation.
+#
+# The continuation k is a linked list of Continuation frames on the
+# heap, so Scheme recursion depth is bounded by memory rather than by
+# the Python stack.  A node's run(env, k) method returns a triple:
+# either (node, env, k) to evaluate another node, or (None, value, k)
+# to return a value to k.  A frame resumes by calling its node's
+# resume(value, env, state, k), which returns a triple the same way.
+#
+# Constants, variable references and lambdas are "simple": they can't
+# call procedures, so nodes evaluate them directly with evaluate(env)
+# instead of pushing a frame.
+
+class Continuation(object):
+    __slots__ = ('node', 'env', 'state', 'next')
+
+    def __init__(self, node, env, state, next):
+        self.node = node
+        self.env = env
+        self.state = state
+        self.next = next
+
+    def resume(self, value):
+        return self.node.resume(value, self.env, self.state, self.next)
+
+class Constant(object):
+    __slots__ = ('value',)
+    simple = True
+
+    def __init__(self, value):
+        self.value = value
+
+    def evaluate(self, env):
+        return self.value
+
+    def run(self, env, k):
+        return None, self.value, k
+
+def unassigned_variable(name):
+    exit('variable "%s" used before its definition' % name)
+
+class LocalVariable(object):
+    __slots__ = ('name', 'index')
+    simple = True
+
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+
+    def evaluate(self, env):
+        value = env.values[self.index]
+        if value is Unassigned:
+            unassigned_variable(self.name)
+        return value
+
+    def run(self, env, k):
+        return None, self.evaluate(env), k
+
+class OuterVariable(object):
+    __slots__ = ('name', 'depth', 'index')
+    simple = True
+
+    def __init__(self, name, depth, index):
+        self.name = name
+        self.depth = depth
+        self.index = index
+
+    def evaluate(self, env):
+        for i in range(self.depth):
+            env = env.parent
+        value = env.values[self.index]
+        if value is Unassigned:
+            unassigned_variable(self.name)
+        return value
+
+    def run(self, env, k):
+        return None, self.evaluate(env), k
+
+class GlobalVariable(object):
+    __slots__ = ('name', 'env')
+    simple = True
+
+    def __init__(self, name, env):
+        self.name = name
+        self.env = env
+
+    def evaluate(self, env):
+        value = self.env.get(self.name, Unassigned)
+        if value is Unassigned:
+            value = self.env[self.name]
+        return value
+
+    def run(self, env, k):
+        return None, self.evaluate(env), k
+
+class Lambda(object):
+    __slots__ = ('nparams', 'rest', 'body', 'padding')
+    simple = True
+
+    def __init__(self, nparams, rest, body, nvars):
+        self.nparams = nparams
+        self.rest = rest
+        self.body = body
+        self.padding = [Unassigned] * (nvars - nparams - rest)
+
+    def bind(self, args, env):
+        nparams = self.nparams
+        if len(args) != nparams:
+            if len(args) < nparams:
+                exit('too few arguments')
+            if not self.rest:
+                exit('too many arguments')
+        if self.rest:
+            args[nparams:] = [scheme_list(args[nparams:])]
+        if self.padding:
+            args.extend(self.padding)
+        return Frame(args, env)
+
+    def evaluate(self, env):
+        return Compound(self, env)
+
+    def run(self, env, k):
+        return None, Compound(self, env), k
+
+class LocalDefinition(object):
+    __slots__ = ('index', 'value')
+    simple = False
+
+    def __init__(self, index, value):
+        self.index = index
+        self.value = value
+
+    def run(self, env, k):
+        if self.value.simple:
+            return self.resume(self.value.evaluate(env), env, None, k)
+        return self.value, env, Continuation(self, env, None, k)
+
+    def resume(self, value, env, state, k):
+        env.values[self.index] = value
+        return None, Symbol('ok'), k
+
+class GlobalDefinition(object):
+    __slots__ = ('name', 'value', 'env')
+    simple = False
+
+    def __init__(self, name, value, env):
+        self.name = name
+        self.value = value
+        self.env = env
+
+    def run(self, env, k):
+        if self.value.simple:
+            return self.resume(self.value.evaluate(env), env, None, k)
+        return self.value, env, Continuation(self, env, None, k)
+
+    def resume(self, value, env, state, k):
+        self.env[self.name] = value
+        return None, Symbol('ok'), k
+
+class LocalAssignment(object):
+    __slots__ = ('depth', 'index', 'value')
+    simple = False
+
+    def __init__(self, depth, index, value):
+        self.depth = depth
+        self.index = index
+        self.value = value
+
+    def run(self, env, k):
+        if self.value.simple:
+            return self.resume(self.value.evaluate(env), env, None, k)
+        return self.value, env, Continuation(self, env, None, k)
+
+    def resume(self, value, env, state, k):
+        frame = env
+        for i in range(self.depth):
+            frame = frame.parent
+        frame.values[self.index] = value
+        return None, Symbol('ok'), k
+
+class GlobalAssignment(object):
+    __slots__ = ('name', 'value', 'env')
+    simple = False
+
+    def __init__(self, name, value, env):
+        self.name = name
+        self.value = value
+        self.env = env
+
+    def run(self, env, k):
+        if self.value.simple:
+            return self.resume(self.value.evaluate(env), env, None, k)
+        return self.value, env, Continuation(self, env, None, k)
+
+    def resume(self, value, env, state, k):
+        self.env.set_variable(self.name, value)
+        return None, Symbol('ok'), k
+
+class If(object):
+    __slots__ = ('predicate', 'consequent', 'alternative')
+    simple = False
+
+    def __init__(self, predicate, consequent, alternative):
+        self.predicate = predicate
+        self.consequent = consequent
+        self.alternative = alternative
+
+    def run(self, env, k):
+        if self.predicate.simple:
+            return self.resume(self.predicate.evaluate(env), env, None, k)
+        return self.predicate, env, Continuation(self, env, None, k)
+
+    def resume(self, value, env, state, k):
+        if value is not False:
+            return self.consequent, env, k
+        return self.alternative, env, k
+
+class Sequence(object):
+    __slots__ = ('nodes',)
+    simple = False
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def run(self, env, k):
+        return self.nodes[0], env, Continuation(self, env, 1, k)
+
+    def resume(self, value, env, i, k):
+        if i == len(self.nodes) - 1:
+            return self.nodes[i], env, k
+        return self.nodes[i], env, Continuation(self, env, i + 1, k)
+
+class And(object):
+    __slots__ = ('nodes',)
+    simple = False
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def run(self, env, k):
+        return self.resume(True, env, 0, k)
+
+    def resume(self, value, env, i, k):
+        if value is False:
+            return None, value, k
+        if i == len(self.nodes) - 1:
+            return self.nodes[i], env, k
+        return self.nodes[i], env, Continuation(self, env, i + 1, k)
+
+class Or(object):
+    __slots__ = ('nodes',)
+    simple = False
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def run(self, env, k):
+        return self.resume(False, env, 0, k)
+
+    def resume(self, value, env, i, k):
+        if value is not False:
+            return None, value, k
+        if i == len(self.nodes) - 1:
+            return self.nodes[i], env, k
+        return self.nodes[i], env, Continuation(self, env, i + 1, k)
+
+class Application(object):
+    __slots__ = ('nodes', 'all_simple', 'tail')
+    simple = False
+
+    def __init__(self, operator, operands):
+        self.nodes = [operator] + operands
+        self.all_simple = all(node.simple for node in self.nodes)
+        self.tail = False       # set by mark_tail_calls()
+
+    def run(self, env, k):
+        if self.all_simple:
+            return self.apply([node.evaluate(env) for node in self.nodes], k)
+        return self.evaluate_from([], env, k)
+
+    def evaluate_from(self, values, env, k):
+        # values is always a fresh list, so it may be extended here.
+        nodes = self.nodes
+        for i in range(len(values), len(nodes)):
+            node = nodes[i]
+            if not node.simple:
+                return node, env, Continuation(self, env, values, k)
+            values.append(node.evaluate(env))
+        return self.apply(values, k)
+
+    def resume(self, value, env, values, k):
+        return self.evaluate_from(values + [value], env, k)
+
+    def apply(self, values, k):
+        # values has not been captured by a continuation, so it can
+        # become the argument list.
+        proc = values.pop(0)
+        if not isinstance(proc, Procedure):
+            exit('attempt to apply a non-procedure')
+        return proc.apply(values, k)
+
+# First-class continuations
+#
+# Because k is an immutable linked list of frames, capturing it is O(1):
+# a ContinuationProc just keeps a reference to k along with the list of
+# dynamic-wind extents active at capture time.  Invoking it runs the
+# after thunks of the extents being left and the before thunks of the
+# extents being entered, then returns its argument to the captured k.
+# When no extents differ, as for escapes from loops, that is a single
+# step.
+
+class Winder(object):
+    __slots__ = ('before', 'after', 'parent', 'depth')
+
+    def __init__(self, before, after, parent):
+        self.before = before
+        self.after = after
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+
+winders = None
+
+def wind_steps(current, target):
+    def depth(w):
+        return -1 if w is None else w.depth
+    exits, entries = [], []
+    while current is not target:
+        if depth(current) >= depth(target):
+            exits.append((current.parent, current.after))
+            current = current.parent
+        else:
+            entries.append((target.parent, target.before))
+            target = target.parent
+    return exits + entries[::-1]
+
+class ContinuationProc(Procedure):
+    __slots__ = ('k', 'winders')
+
+    def __init__(self, k, winders):
+        self.k = k
+        self.winders = winders
+
+    def apply(self, args, k):
+        if len(args) != 1:
+            exit('continuation: wrong number of arguments')
+        if self.winders is winders:
+            return None, args[0], self.k
+        return self.throw(args[0])
+
+    def throw(self, value):
+        if self.winders is winders:
+            return None, value, self.k
+        steps = wind_steps(winders, self.winders)
+        return rewind.resume(None, None, (steps, 0, value, self.winders),
+                             self.k)
+
+# These are continuation-frame nodes for the control procedures above;
+# they aren't produced by analyze().
+
+class Rewind(object):
+
+    def resume(self, ignored, env, state, k):
+        global winders
+        steps, i, value, target = state
+        if i == len(steps):
+            winders = target
+            return None, value, k
+        winders, thunk = steps[i]
+        return apply_procedure(thunk, [],
+                               Continuation(self, None,
+                                            (steps, i + 1, value, target), k))
+
+class WindBody(object):
+
+    def resume(self, ignored, env, state, k):
+        global winders
+        before, thunk, after = state
+        winders = Winder(before, after, winders)
+        return apply_procedure(thunk, [],
+                               Continuation(unwind_body, None, after, k))
+
+class UnwindBody(object):
+
+    def resume(self, value, env, after, k):
+        global winders
+        winders = winders.parent
+        return apply_procedure(after, [],
+                               Continuation(return_value, None, value, k))
+
+class MapStep(object):
+
+    def next(self, proc, lists, results, k):
+        while all(isinstance(lst, Pair) for lst in lists):
+            args = [lst.car for lst in lists]
+            lists = [lst.cdr for lst in lists]
+            if proc.__class__ is not Primitive:
+                return apply_procedure(proc, args,
+                                       Continuation(self, None,
+                                                    (proc, lists, results), k))
+            results = cons(proc.call(args), results)
+        return None, reverse(results), k
+
+    def resume(self, value, env, state, k):
+        proc, lists, results = state
+        return self.next(proc, lists, cons(value, results), k)
+
+class F64MapStep(object):
+
+    def next(self, proc, vectors, i, results, k):
+        n = len(results)
+        while i < n:
+            args = [items[i] for items in vectors]
+            if proc.__class__ is not Primitive:
+                state = proc, vectors, i, results
+                return apply_procedure(proc, args,
+                                       Continuation(self, None, state, k))
+            results[i] = real_item(proc.call(args), 'f64vector-map')
+            i += 1
+        return None, F64Vector(results), k
+
+    def resume(self, value, env, state, k):
+        proc, vectors, i, results = state
+        results[i] = real_item(value, 'f64vector-map')
+        return self.next(proc, vectors, i + 1, results, k)
+
+class ForEachStep(object):
+
+    def next(self, proc, lists, k):
+        while all(isinstance(lst, Pair) for lst in lists):
+            args = [lst.car for lst in lists]
+            lists = [lst.cdr for lst in lists]
+            if proc.__class__ is not Primitive:
+                return apply_procedure(proc, args,
+                                       Continuation(self, None,
+                                                    (proc, lists), k))
+            proc.call(args)
+        return None, True, k
+
+    def resume(self, value, env, state, k):
+        proc, lists = state
+        return self.next(proc, lists, k)
+
+class WalkStep(object):
+
+    def next(self, proc, entries, i, k):
+        while i < len(entries):
+            args = list(entries[i])
+            i += 1
+            if proc.__class__ is not Primitive:
+                return apply_procedure(proc, args,
+                                       Continuation(self, None,
+                                                    (proc, entries, i), k))
+            proc.call(args)
+        return None, True, k
+
+    def resume(self, value, env, state, k):
+        proc, entries, i = state
+        return self.next(proc, entries, i, k)
+
+class ReturnValue(object):
+
+    def resume(self, ignored, env, value, k):
+        return None, value, k
+
+rewind = Rewind()
+wind_body = WindBody()
+unwind_body = UnwindBody()
+map_step = MapStep()
+f64_map_step = F64MapStep()
+for_each_step = ForEachStep()
+walk_step = WalkStep()
+return_value = ReturnValue()
+
+# Control primitives
+
+def apply_proc(k, proc, *args):
+    args = list(args)
+    args.extend(python_list(args.pop(), 'apply'))
+    return apply_procedure(proc, args, k)
+
+def eval_proc(k, exp, env):
+    return prepare(exp, env), env, k
+
+def call_cc_proc(k, proc):
+    return apply_procedure(proc, [ContinuationProc(k, winders)], k)
+
+def dynamic_wind_proc(k, before, thunk, after):
+    return apply_procedure(before, [],
+                           Continuation(wind_body, None,
+                                        (before, thunk, after), k))
+
+def map_proc(k, proc, *lists):
+    return map_step.next(proc, lists, None, k)
+
+def for_each_proc(k, proc, *lists):
+    return for_each_step.next(proc, lists, k)
+
+def f64vector_map_proc(k, proc, *vectors):
+    vectors = [check_f64vector(v, 'f64vector-map').items for v in vectors]
+    n = min(len(items) for items in vectors)
+    if proc.__class__ is Primitive:
+        if not proc.min_args <= len(vectors) <= proc.limit:
+            proc.wrong_arity()
+        results = list(map(proc.func, *[items[:n] for items in vectors]))
+        if not all(z.__class__ is float for z in results):
+            results = real_items(results, 'f64vector-map')
+        return None, F64Vector(results), k
+    return f64_map_step.next(proc, vectors, 0, array.array('d', [0.0]) * n, k)
+
+def hash_table_ref_proc(k, table, key, fail=None):
+    table = check_hash_table(table, 'hash-table-ref')
+    entry = table.entries.get(table.key(key))
+    if entry is not None:
+        return None, entry[1], k
+    if fail is None:
+        exit('hash-table-ref: key not found')
+    return apply_procedure(fail, [], k)
+
+def hash_table_walk_proc(k, table, proc):
+    table = check_hash_table(table, 'hash-table-walk')
+    return walk_step.next(proc, list(table.entries.values()), 0, k)
+
+# Profiler
+#
+# "scheme.py --profile FILE" counts calls, inclusive and exclusive time
+# and allocations (pairs, frames and closures) for every compound
+# procedure and primitive.  At exit it prints a report to stderr and
+# writes FILE in callgrind format, for kcachegrind and similar tools.
+#
+# While profiling, the reader notes the line of every list, and the
+# analyzer wraps each Lambda's body in a ProfileEntry node named after
+# the variable the lambda is defined as.  Entering a body switches the
+# profiler to the procedure's record and pushes a profile_exit frame,
+# which switches back when the body returns.  A tail call replaces the
+# caller's profile_exit frame, ending the caller's time, so loops still
+# run in constant space.  Primitives are timed by wrapping their
+# functions.  Time in procedures abandoned by escaping continuations
+# isn't counted as inclusive time.
+
+profiler = None
+
+class ProfileRecord(object):
+    __slots__ = ('name', 'source', 'calls', 'inclusive', 'exclusive',
+                 'allocations', 'active', 'callees')
+
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source        # (file, line), or None
+        self.calls = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+        self.allocations = 0
+        self.active = 0             # activations in progress
+        self.callees = {}           # record -> [calls, time, allocations]
+
+    def label(self):
+        if self.source is None:
+            return self.name
+        return '%s (%s:%d)' % ((self.name,) + self.source)
+
+class Profiler(object):
+
+    def __init__(self):
+        self.records = {}
+        self.locations = {}         # list read -> (file, line)
+        self.source = None          # location of the form being analyzed
+        self.current = self.record('<toplevel>', None)
+        self.allocated = 0
+        self.last_allocated = 0
+        self.last_time = time.time()
+
+    def record(self, name, source):
+        key = name, source
+        if key not in self.records:
+            self.records[key] = ProfileRecord(name, source)
+        return self.records[key]
+
+    def switch(self, record):
+        # Charge the time and allocations since the last switch to the
+        # current record, then make record current.
+        now = time.time()
+        current = self.current
+        current.exclusive += now - self.last_time
+        current.allocations += self.allocated - self.last_allocated
+        self.current = record
+        self.last_time = now
+        self.last_allocated = self.allocated
+        return now
+
+    def enter(self, record):
+        caller = self.current
+        now = self.switch(record)
+        record.calls += 1
+        record.active += 1
+        return caller, now, self.allocated
+
+    def leave(self, record, caller, start, allocated):
+        now = self.switch(caller)
+        record.active -= 1
+        if not record.active:
+            record.inclusive += now - start
+        edge = caller.callees.get(record)
+        if edge is None:
+            edge = caller.callees[record] = [0, 0.0, 0]
+        edge[0] += 1
+        edge[1] += now - start
+        edge[2] += self.allocated - allocated
+
+    def profile_primitive(self, prim):
+        func = prim.func
+        record = self.record(prim.name, None)
+        def profiled(*args):
+            state = self.enter(record)
+            try:
+                return func(*args)
+            finally:
+                self.leave(record, *state)
+        prim.func = profiled
+
+    def count_allocations(self, cls):
+        init = cls.__init__
+        def counted_init(obj, *args):
+            self.allocated += 1
+            init(obj, *args)
+        cls.__init__ = counted_init
+
+    def report(self, f):
+        self.switch(self.current)
+        records = sorted(self.records.values(),
+                         key=lambda r: r.exclusive, reverse=True)
+        f.write('%10s %10s %10s %10s  %s\n' %
+                ('calls', 'incl s', 'excl s', 'allocs', 'procedure'))
+        for r in records:
+            if r.calls or r.exclusive:
+                f.write('%10d %10.3f %10.3f %10d  %s\n' %
+                        (r.calls, r.inclusive, r.exclusive, r.allocations,
+                         r.label()))
+
+    def write_callgrind(self, f):
+        def position(r):
+            return ('<builtin>', 0) if r.source is None else r.source
+        f.write('# callgrind format\nversion: 1\ncreator: pyscheme\n'
+                'positions: line\nevents: Microseconds Allocations\n')
+        for r in self.records.values():
+            if not (r.calls or r.exclusive):
                 continue
-            if proc is apply_proc:
-                proc = car(args)
-                args = apply_operands(args)
-            if is_primitive_proc(proc):
-                return proc(args)
+            fname, line = position(r)
+            f.write('\nfl=%s\nfn=%s\n%d %d %d\n' %
+                    (fname, r.name, line, r.exclusive * 1e6, r.allocations))
+            for callee, (calls, t, allocations) in r.callees.items():
+                cfname, cline = position(callee)
+                f.write('cfl=%s\ncfn=%s\ncalls=%d %d\n%d %d %d\n' %
+                        (cfname, callee.name, calls, cline,
+                         line, t * 1e6, allocations))
+
+class ProfileEntry(object):
+    __slots__ = ('record', 'body')
+    simple = False
+
+    def __init__(self, record, body):
+        self.record = record
+        self.body = body
+
+    def run(self, env, k):
+        if k is not None and k.node is profile_exit:
+            profile_exit.resume(None, None, k.state, None)
+            caller = k.state[1]
+            k = k.next
+        else:
+            caller = profiler.current
+        state = profiler.enter(self.record)
+        state = (self.record, caller) + state[1:]
+        return self.body, env, Continuation(profile_exit, None, state, k)
+
+class ProfileExit(object):
+
+    def resume(self, value, env, state, k):
+        profiler.leave(*state)
+        return None, value, k
+
+profile_exit = ProfileExit()
+
+def start_profiling():
+    global profiler
+    profiler = Profiler()
+    for prim in primitives.values():
+        profiler.profile_primitive(prim)
+    for cls in Pair, Frame, Compound:
+        profiler.count_allocations(cls)
+
+def stop_profiling(fname):
+    profiler.report(sys.stderr)
+    with open(fname, 'w') as f:
+        profiler.write_callgrind(f)
+
+# Counters and trace hooks
+#
+# (start-counters) starts counting special forms run, variable lookups
+# by lexical depth, frames and pairs created, and tail and non-tail
+# calls; (counters) returns the counts as an association list and
+# (stop-counters) stops.  Python code embedding the interpreter can
+# also call set_trace_hook(hook): hook('eval', node, env) is called as
+# each node runs and hook('apply', proc, args) as each application
+# applies a procedure.
+#
+# The evaluator contains no counting or tracing code.  Starting either
+# one replaces the methods below with wrappers, and stopping both puts
+# the originals back, so instrumentation costs nothing when it's off.
+# Only the tree walker is instrumented; under --bytecode, only frames,
+# pairs and calls made through execute() are seen.
+
+counters = None
+trace_hook = None
+
+class Counters(object):
+
+    def __init__(self):
+        self.forms = {}
+        self.lookups = {}
+        self.frames = 0
+        self.pairs = 0
+        self.tail_calls = 0
+        self.calls = 0
+
+    def as_list(self):
+        def alist(d):
+            return scheme_list([cons(key, d[key])
+                                for key in sorted(d, key=str)])
+        return scheme_list([
+            cons(Symbol('forms'), alist(self.forms)),
+            cons(Symbol('lookup-depths'), alist(self.lookups)),
+            cons(Symbol('frames'), self.frames),
+            cons(Symbol('pairs'), self.pairs),
+            cons(Symbol('tail-calls'), self.tail_calls),
+            cons(Symbol('non-tail-calls'), self.calls)])
+
+# Quoted data and literals both analyze to Constant, so constants get a
+# name of their own rather than passing for quote forms.
+form_names = [
+    (Constant,          'constant'),
+    (Lambda,            'lambda'),
+    (LocalDefinition,   'define'),
+    (GlobalDefinition,  'define'),
+    (LocalAssignment,   'set!'),
+    (GlobalAssignment,  'set!'),
+    (If,                'if'),
+    (Sequence,          'begin'),
+    (And,               'and'),
+    (Or,                'or'),
+    (Application,       'application'),
+    ]
+
+def counted_run(run, name):
+    name = Symbol(name)
+    def wrapper(node, env, k):
+        if counters is not None:
+            counters.forms[name] = counters.forms.get(name, 0) + 1
+        if trace_hook is not None:
+            trace_hook('eval', node, env)
+        return run(node, env, k)
+    return wrapper
+
+# Constants and lambdas among the operands of an application, or the
+# values of definitions and tests of ifs, are evaluated directly rather
+# than run, so they're counted there too.
+def counted_evaluate(evaluate, name):
+    name = Symbol(name)
+    def wrapper(node, env):
+        if counters is not None:
+            counters.forms[name] = counters.forms.get(name, 0) + 1
+        if trace_hook is not None:
+            trace_hook('eval', node, env)
+        return evaluate(node, env)
+    return wrapper
+
+def counted_lookup(evaluate, depth):
+    def wrapper(node, env):
+        if counters is not None:
+            d = depth if depth is not None else node.depth
+            counters.lookups[d] = counters.lookups.get(d, 0) + 1
+        return evaluate(node, env)
+    return wrapper
+
+def counted_apply(apply):
+    def wrapper(node, values, k):
+        if counters is not None:
+            if node.tail:
+                counters.tail_calls += 1
             else:
-                exp, env = proc(args)
+                counters.calls += 1
+        if trace_hook is not None:
+            trace_hook('apply', values[0], values[1:])
+        return apply(node, values, k)
+    return wrapper
+
+def counted_init(init, attr):
+    def wrapper(obj, *args):
+        if counters is not None:
+            setattr(counters, attr, getattr(counters, attr) + 1)
+        init(obj, *args)
+    return wrapper
+
+instrumented = {}               # (class, method name) -> original
+
+def instrument():
+    def wrap(cls, attr, wrapper):
+        instrumented[cls, attr] = cls.__dict__[attr]
+        setattr(cls, attr, wrapper)
+    if counters is None and trace_hook is None:
+        for (cls, attr), original in instrumented.items():
+            setattr(cls, attr, original)
+        instrumented.clear()
+    elif not instrumented:
+        for cls, name in form_names:
+            wrap(cls, 'run', counted_run(cls.run, name))
+            if cls.simple:
+                wrap(cls, 'evaluate', counted_evaluate(cls.evaluate, name))
+        for cls, depth in ((LocalVariable, 0), (OuterVariable, None),
+                           (GlobalVariable, Symbol('global'))):
+            wrap(cls, 'evaluate', counted_lookup(cls.evaluate, depth))
+        wrap(Application, 'apply', counted_apply(Application.apply))
+        wrap(Frame, '__init__', counted_init(Frame.__init__, 'frames'))
+        wrap(Pair, '__init__', counted_init(Pair.__init__, 'pairs'))
+
+def set_trace_hook(hook):
+    global trace_hook
+    trace_hook = hook
+    instrument()
+
+def start_counters_proc():
+    global counters
+    counters = Counters()
+    instrument()
+    return Symbol('ok')
+
+def stop_counters_proc():
+    global counters
+    counters = None
+    instrument()
+    return Symbol('ok')
+
+def counters_proc():
+    if counters is None:
+        return None
+    return counters.as_list()
+
+def analyze_list(exps, scope):
+    nodes = []
+    while exps is not None:
+        nodes.append(analyze(car(exps), scope))
+        exps = cdr(exps)
+    return nodes
+
+def analyze_sequence(exps, scope):
+    nodes = analyze_list(exps, scope)
+    if not nodes:
+        exit('empty sequence')
+    if len(nodes) == 1:
+        return nodes[0]
+    return Sequence(nodes)
+
+def definition_variable(exp):
+    var = cadr(exp)
+    if isinstance(var, Pair):
+        return car(var)
+    return var
+
+def scan_out_defines(body, scope):
+    while body is not None:
+        exp = car(body)
+        if is_definition(exp):
+            var = definition_variable(exp)
+            if var not in scope.vars:
+                scope.vars.append(var)
+        elif is_begin(exp):
+            scan_out_defines(cdr(exp), scope)
+        body = cdr(body)
+
+def analyze_lambda(params, body, scope, name='lambda'):
+    if profiler is not None:
+        source = profiler.source
+    vars = []
+    while isinstance(params, Pair):
+        vars.append(car(params))
+        params = cdr(params)
+    nparams = len(vars)
+    rest = params is not None
+    if rest:
+        vars.append(params)
+    scope = Scope(vars, scope)
+    scan_out_defines(body, scope)
+    body = analyze_sequence(body, scope)
+    mark_tail_calls(body)
+    if profiler is not None:
+        body = ProfileEntry(profiler.record(name, source), body)
+        profiler.source = source
+    return Lambda(nparams, rest, body, len(vars))
+
+# Mark the applications that are in tail position in node, which are
+# those that run without pushing a continuation frame.
+def mark_tail_calls(node):
+    while True:
+        cls = node.__class__
+        if cls is Application:
+            node.tail = True
+            return
+        elif cls is If:
+            mark_tail_calls(node.consequent)
+            node = node.alternative
+        elif cls is Sequence or cls is And or cls is Or:
+            node = node.nodes[-1]
+        else:
+            return
+
+def lexical_address(var, scope):
+    depth = 0
+    while isinstance(scope, Scope):
+        if var in scope.vars:
+            return depth, scope.vars.index(var)
+        scope = scope.parent
+        depth += 1
+    return None
+
+def global_scope(scope):
+    while isinstance(scope, Scope):
+        scope = scope.parent
+    return scope
+
+def analyze_variable(var, scope):
+    address = lexical_address(var, scope)
+    if address is None:
+        return GlobalVariable(var, global_scope(scope))
+    depth, index = address
+    if depth == 0:
+        return LocalVariable(var, index)
+    return OuterVariable(var, depth, index)
+
+def analyze_definition(exp, scope):
+    var = cadr(exp)
+    if isinstance(var, Pair):
+        var, params = car(var), cdr(var)
+        value = analyze_lambda(params, cddr(exp), scope, var)
+    elif is_lambda(caddr(exp)):
+        value = analyze_lambda(cadr(caddr(exp)), cddr(caddr(exp)), scope, var)
+    else:
+        value = analyze(caddr(exp), scope)
+    if not isinstance(scope, Scope):
+        return GlobalDefinition(var, value, scope)
+    if var not in scope.vars:
+        scope.vars.append(var)
+    return LocalDefinition(scope.vars.index(var), value)
+
+def analyze_assignment(exp, scope):
+    var = cadr(exp)
+    value = analyze(caddr(exp), scope)
+    address = lexical_address(var, scope)
+    if address is None:
+        return GlobalAssignment(var, value, global_scope(scope))
+    depth, index = address
+    return LocalAssignment(depth, index, value)
+
+def analyze_if(exp, scope):
+    if isinstance(cdddr(exp), Pair):
+        alternative = analyze(cadddr(exp), scope)
+    else:
+        alternative = Constant(False)
+    return If(analyze(cadr(exp), scope),
+              analyze(caddr(exp), scope),
+              alternative)
+
+def analyze_quotation(exp, scope):
+    return Constant(cadr(exp))
+
+def analyze_lambda_expression(exp, scope):
+    return analyze_lambda(cadr(exp), cddr(exp), scope)
+
+def analyze_begin(exp, scope):
+    return analyze_sequence(cdr(exp), scope)
+
+def analyze_let(exp, scope):
+    if isinstance(cadr(exp), Symbol):
+        return analyze(named_let_to_letrec(exp), scope)
+    return analyze(let_to_application(exp), scope)
+
+def analyze_and(exp, scope):
+    if cdr(exp) is None:
+        return Constant(True)
+    return And(analyze_list(cdr(exp), scope))
+
+def analyze_or(exp, scope):
+    if cdr(exp) is None:
+        return Constant(False)
+    return Or(analyze_list(cdr(exp), scope))
+
+def analyze_derived(transform):
+    return lambda exp, scope: analyze(transform(exp), scope)
+
+special_forms = {}
+for name, analyzer in [
+        ('quote',               analyze_quotation),
+        ('define',              analyze_definition),
+        ('set!',                analyze_assignment),
+        ('if',                  analyze_if),
+        ('lambda',              analyze_lambda_expression),
+        ('begin',               analyze_begin),
+        ('cond',                analyze_derived(cond_to_if)),
+        ('let',                 analyze_let),
+        ('let*',                analyze_derived(let_star_to_let)),
+        ('letrec',              analyze_derived(letrec_to_let)),
+        ('case',                analyze_derived(case_to_cond)),
+        ('do',                  analyze_derived(do_to_named_let)),
+        ('define-syntax',       analyze_define_syntax),
+        ('and',                 analyze_and),
+        ('or',                  analyze_or),
+        ]:
+    special_forms[Symbol(name)] = analyzer
+
+def analyze(exp, scope):
+    # Only lists have locations, and vectors can't be dictionary keys.
+    if profiler is not None and exp.__class__ is Pair:
+        profiler.source = profiler.locations.get(exp, profiler.source)
+    if is_variable(exp):
+        return analyze_variable(exp, scope)
+    elif is_self_evaluating(exp):
+        return Constant(exp)
+    elif not is_application(exp):
+        exit('must be expression: "%s"' % exp)
+    if isinstance(exp.car, Symbol):
+        macro = lookup_macro(exp.car, scope)
+        if macro is not None:
+            return analyze(macro.expand(exp), scope)
+        analyzer = special_forms.get(exp.car)
+        if analyzer is not None:
+            return analyzer(exp, scope)
+    return Application(analyze(car(exp), scope),
+                       analyze_list(cdr(exp), scope))
+
+# Bytecode
+#
+# With --bytecode, each top-level form is analyzed as usual and the node
+# tree is then compiled into Bytecode: an array of opcodes and operands
+# plus a constants list.  Every Lambda's body is compiled too, so
+# Compound procedures run as Bytecode nodes.  run_bytecode() executes an
+# instruction stream in one Python loop with an operand stack.  Calls to
+# primitives, and calls and returns between Bytecode procedures, stay
+# inside the loop; anything else (control primitives, continuations)
+# goes back to execute() with the loop's state saved in an ordinary
+# Continuation frame, so call/cc and dynamic-wind work unchanged.
+
+use_bytecode = False
+
+(CONST, LOCAL, OUTER, GLOBAL, CLOSURE, DEFINE_LOCAL, DEFINE_GLOBAL,
+ SET_LOCAL, SET_GLOBAL, POP, JUMP, JUMP_IF_FALSE, FALSE_OR_POP,
+ TRUE_OR_POP, RETURN, CALL, TAIL_CALL, CALL_GLOBAL,
+ TAIL_CALL_GLOBAL) = range(19)
+
+class Bytecode(object):
+    __slots__ = ('ops', 'consts', 'env')
+    simple = False
+
+    def __init__(self, env):
+        self.ops = array.array('l')
+        self.consts = []
+        self.env = env
+
+    def emit(self, op, *operands):
+        self.ops.append(op)
+        self.ops.extend(operands)
+
+    def const(self, value):
+        for i, c in enumerate(self.consts):
+            if c is value:
+                return i
+        self.consts.append(value)
+        return len(self.consts) - 1
+
+    def label(self):
+        return len(self.ops)
+
+    def patch(self, at):
+        self.ops[at] = len(self.ops)
+
+    def run(self, env, k):
+        return run_bytecode(self, 0, [], env, k)
+
+    def resume(self, value, env, state, k):
+        pc, stack = state
+        return run_bytecode(self, pc, stack + [value], env, k)
+
+def compile_node(node, code, tail):
+    cls = node.__class__
+    if cls is Constant:
+        code.emit(CONST, code.const(node.value))
+    elif cls is LocalVariable:
+        code.emit(LOCAL, node.index, code.const(node.name))
+    elif cls is OuterVariable:
+        code.emit(OUTER, node.depth, node.index, code.const(node.name))
+    elif cls is GlobalVariable:
+        code.emit(GLOBAL, code.const(node.name))
+    elif cls is Lambda:
+        if node.body.__class__ is ProfileEntry:
+            node.body.body = compile_body(node.body.body, code.env)
+        else:
+            node.body = compile_body(node.body, code.env)
+        code.emit(CLOSURE, code.const(node))
+    elif cls is LocalDefinition:
+        compile_node(node.value, code, False)
+        code.emit(DEFINE_LOCAL, node.index)
+    elif cls is GlobalDefinition:
+        compile_node(node.value, code, False)
+        code.emit(DEFINE_GLOBAL, code.const(node.name))
+    elif cls is LocalAssignment:
+        compile_node(node.value, code, False)
+        code.emit(SET_LOCAL, node.depth, node.index)
+    elif cls is GlobalAssignment:
+        compile_node(node.value, code, False)
+        code.emit(SET_GLOBAL, code.const(node.name))
+    elif cls is If:
+        compile_node(node.predicate, code, False)
+        code.emit(JUMP_IF_FALSE, 0)
+        to_alternative = code.label() - 1
+        compile_node(node.consequent, code, tail)
+        if not tail:
+            code.emit(JUMP, 0)
+            to_end = code.label() - 1
+        code.patch(to_alternative)
+        compile_node(node.alternative, code, tail)
+        if not tail:
+            code.patch(to_end)
+        return
+    elif cls is Sequence:
+        for n in node.nodes[:-1]:
+            compile_node(n, code, False)
+            code.emit(POP)
+        compile_node(node.nodes[-1], code, tail)
+        return
+    elif cls is And or cls is Or:
+        op = FALSE_OR_POP if cls is And else TRUE_OR_POP
+        to_end = []
+        for n in node.nodes[:-1]:
+            compile_node(n, code, False)
+            code.emit(op, 0)
+            to_end.append(code.label() - 1)
+        # In tail position the last operand returns or tail calls
+        # itself, and an operand that ends the form early jumps to a
+        # RETURN of its value.
+        compile_node(node.nodes[-1], code, tail)
+        for at in to_end:
+            code.patch(at)
+        if tail:
+            code.emit(RETURN)
+        return
+    elif cls is Application:
+        # Most calls are to global procedures, so their operator is
+        # fetched by the call instruction rather than pushed.
+        operator, operands = node.nodes[0], node.nodes[1:]
+        if operator.__class__ is not GlobalVariable:
+            compile_node(operator, code, False)
+        for n in operands:
+            compile_node(n, code, False)
+        if operator.__class__ is GlobalVariable:
+            code.emit(TAIL_CALL_GLOBAL if tail else CALL_GLOBAL,
+                      len(operands), code.const(operator.name))
+        else:
+            code.emit(TAIL_CALL if tail else CALL, len(operands), 0)
+        return
+    else:
+        exit("can't compile %s" % cls.__name__)
+    if tail:
+        code.emit(RETURN)
+
+def compile_body(node, env):
+    code = Bytecode(env)
+    compile_node(node, code, True)
+    return code
+
+# The opcodes and classes the loop tests most often are bound as default
+# arguments, which makes them local variables rather than globals.
+def run_bytecode(code, pc, stack, env, k,
+                 LOCAL=LOCAL, CONST=CONST, GLOBAL=GLOBAL,
+                 JUMP_IF_FALSE=JUMP_IF_FALSE, RETURN=RETURN, CALL=CALL,
+                 TAIL_CALL=TAIL_CALL, CALL_GLOBAL=CALL_GLOBAL,
+                 TAIL_CALL_GLOBAL=TAIL_CALL_GLOBAL, Primitive=Primitive,
+                 Compound=Compound, Bytecode=Bytecode, Frame=Frame,
+                 Continuation=Continuation, Unassigned=Unassigned,
+                 ContinuationProc=ContinuationProc):
+    ops, consts, genv = code.ops, code.consts, code.env
+    while True:
+        op = ops[pc]
+        if op == LOCAL:
+            value = env.values[ops[pc + 1]]
+            if value is Unassigned:
+                unassigned_variable(consts[ops[pc + 2]])
+            stack.append(value)
+            pc += 3
+        elif op == CONST:
+            stack.append(consts[ops[pc + 1]])
+            pc += 2
+        elif op == GLOBAL:
+            name = consts[ops[pc + 1]]
+            value = genv.get(name, Unassigned)
+            if value is Unassigned:
+                value = genv[name]
+            stack.append(value)
+            pc += 2
+        elif op == JUMP_IF_FALSE:
+            if stack.pop() is False:
+                pc = ops[pc + 1]
+            else:
+                pc += 2
+        elif op >= CALL:
+            i = len(stack) - ops[pc + 1]
+            args = stack[i:]
+            if op >= CALL_GLOBAL:
+                del stack[i:]
+                name = consts[ops[pc + 2]]
+                proc = genv.get(name, Unassigned)
+                if proc is Unassigned:
+                    proc = genv[name]
+                tail = op == TAIL_CALL_GLOBAL
+            else:
+                proc = stack[i - 1]
+                del stack[i - 1:]
+                tail = op == TAIL_CALL
+            pc += 3
+            cls = proc.__class__
+            if cls is Primitive:
+                if not proc.min_args <= len(args) <= proc.limit:
+                    proc.wrong_arity()
+                value = proc.func(*args)
+                if not tail:
+                    stack.append(value)
+                    continue
+                # A tail call to a primitive returns its value.
+                if k is None or k.node.__class__ is not Bytecode:
+                    return None, value, k
+                code, env = k.node, k.env
+                pc, stack = k.state
+                stack = stack + [value]
+                k = k.next
+                ops, consts, genv = code.ops, code.consts, code.env
                 continue
+            if (cls is ContinuationProc and proc.winders is winders
+                    and len(args) == 1):
+                # An escape that leaves no dynamic-wind extent returns
+                # to the captured continuation like RETURN does.
+                value = args[0]
+                k = proc.k
+                if k is None or k.node.__class__ is not Bytecode:
+                    return None, value, k
+                code, env = k.node, k.env
+                pc, stack = k.state
+                stack = stack + [value]
+                k = k.next
+                ops, consts, genv = code.ops, code.consts, code.env
+                continue
+            if not tail:
+                k = Continuation(code, env, (pc, stack), k)
+                stack = []
+            if cls is Compound and proc.code.body.__class__ is Bytecode:
+                lam = proc.code
+                if len(args) == lam.nparams and not lam.rest and not lam.padding:
+                    env = Frame(args, proc.env)
+                else:
+                    env = lam.bind(args, proc.env)
+                code = lam.body
+                ops, consts, genv = code.ops, code.consts, code.env
+                pc = 0
+                continue
+            if not isinstance(proc, Procedure):
+                exit('attempt to apply a non-procedure')
+            # Control procedures such as call/cc usually go on to apply
+            # a compiled procedure; run its body here rather than
+            # returning to execute() to start it.
+            node, env, k = proc.apply(args, k)
+            if node.__class__ is not Bytecode:
+                return node, env, k
+            code = node
+            ops, consts, genv = code.ops, code.consts, code.env
+            pc = 0
+            stack = []
+        elif op == RETURN:
+            value = stack.pop()
+            if k is None or k.node.__class__ is not Bytecode:
+                return None, value, k
+            code, env = k.node, k.env
+            pc, stack = k.state
+            stack = stack + [value]
+            k = k.next
+            ops, consts, genv = code.ops, code.consts, code.env
+        elif op == OUTER:
+            frame = env
+            for i in range(ops[pc + 1]):
+                frame = frame.parent
+            value = frame.values[ops[pc + 2]]
+            if value is Unassigned:
+                unassigned_variable(consts[ops[pc + 3]])
+            stack.append(value)
+            pc += 4
+        elif op == JUMP:
+            pc = ops[pc + 1]
+        elif op == POP:
+            stack.pop()
+            pc += 1
+        elif op == CLOSURE:
+            stack.append(Compound(consts[ops[pc + 1]], env))
+            pc += 2
+        elif op == FALSE_OR_POP:
+            if stack[-1] is False:
+                pc = ops[pc + 1]
+            else:
+                stack.pop()
+                pc += 2
+        elif op == TRUE_OR_POP:
+            if stack[-1] is not False:
+                pc = ops[pc + 1]
+            else:
+                stack.pop()
+                pc += 2
+        elif op == DEFINE_LOCAL:
+            env.values[ops[pc + 1]] = stack[-1]
+            stack[-1] = Symbol('ok')
+            pc += 2
+        elif op == DEFINE_GLOBAL:
+            genv[consts[ops[pc + 1]]] = stack[-1]
+            stack[-1] = Symbol('ok')
+            pc += 2
+        elif op == SET_LOCAL:
+            frame = env
+            for i in range(ops[pc + 1]):
+                frame = frame.parent
+            frame.values[ops[pc + 2]] = stack[-1]
+            stack[-1] = Symbol('ok')
+            pc += 3
+        elif op == SET_GLOBAL:
+            genv.set_variable(consts[ops[pc + 1]], stack[-1])
+            stack[-1] = Symbol('ok')
+            pc += 2
         else:
-            exit('must be expression: "%s"' % exp)
+            exit('bad opcode %d' % op)
 
-def write_pair(f, pair):
-    assert isinstance(pair, Pair)
-    write(f, car(pair))
-    rest = cdr(pair)
-    if isinstance(rest, Pair):
+def execute(node, env):
+    k = None
+    while True:
+        node, result, k = node.run(env, k)
+        while node is None:
+            if k is None:
+                return result
+            node, result, k = k.resume(result)
+        env = result
+
+def prepare(exp, env):
+    node = analyze(exp, env)
+    mark_tail_calls(node)
+    if use_bytecode:
+        node = compile_body(node, env)
+    return node
+
+def scheval(exp, env):
+    return execute(prepare(exp, env), env)
+
+# Output ports
+#
+# An OutputPort collects output in a buffer and passes it to its file
+# in one write when the buffer reaches buffer_size bytes, or when the
+# port is flushed or closed.  The output procedures write a whole
+# object to the buffer and then call written(), so a buffer_size of 0
+# writes through once per procedure.  A line-buffered port, like the
+# standard output on a terminal, is also flushed after a newline.  An
+# output string port has no file and keeps everything it's given.  The
+# file is binary, and what's flushed to it is encoded as Latin-1.
+#
+# Ports with files are kept in file_ports, which doesn't keep them
+# alive, so that what's buffered in ports never closed is flushed when
+# the REPL exits, even on an error; a port collected before then
+# flushes itself.
+
+class OutputPort(object):
+
+    buffer_size = 65536
+
+    def __init__(self, f, buffer_size=None, line_buffered=False):
+        self.file = f
+        self.buffer = io.StringIO()
+        self.write = self.buffer.write
+        if buffer_size is not None:
+            self.buffer_size = buffer_size
+        self.line_buffered = line_buffered
+        if f is not None:
+            file_ports.add(self)
+
+    def written(self, newline=False):
+        if self.file is not None and (self.buffer.tell() >= self.buffer_size
+                                      or newline and self.line_buffered):
+            self.flush()
+
+    def flush(self):
+        if self.file is not None and self.buffer.tell():
+            self.file.write(self.buffer.getvalue().encode('latin-1'))
+            self.file.flush()
+            # A fresh StringIO appends faster than a truncated one.
+            self.buffer = io.StringIO()
+            self.write = self.buffer.write
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            file_ports.discard(self)
+
+    def __del__(self):
+        if self.file is not None and not self.file.closed:
+            self.flush()
+
+    def __reduce__(self):
+        raise TypeError("can't save a port")
+
+file_ports = weakref.WeakSet()
+
+def flush_file_ports():
+    for port in list(file_ports):
+        port.flush()
+
+stdout_port = OutputPort(sys.stdout.buffer,
+                         line_buffered=sys.stdout.isatty())
+
+def write_pair(f, pair, display=False):
+    while True:
+        write(f, pair.car, display)
+        pair = pair.cdr
+        if not isinstance(pair, Pair):
+            break
         f.write(' ')
-        write_pair(f, rest)
-    elif rest is not None:
+    if pair is not None:
         f.write(' . ')
-        write(f, rest)
+        write(f, pair, display)
 
-def write(f, x):
+unescaped_re = re.compile('[%s]' % re.escape(''.join(String.char_to_escape)))
+
+def escape_char(m):
+    return '\\' + String.char_to_escape[m.group()]
+
+def write(f, x, display=False):
     if isinstance(x, bool):
         f.write(x and '#t' or '#f')
-    elif isinstance(x, (int, long)):
+    elif isinstance(x, number_types):
+        f.write(format_number(x))
+    elif display and isinstance(x, (Character, String)):
         f.write(str(x))
     elif isinstance(x, Character):
         x = Character.char_to_name.get(x, x)
         f.write('#\\%s' % x)
     elif isinstance(x, Symbol):
-        f.write(x)
+        f.write(x.name)
     elif isinstance(x, String):
-        s = '"'
-        for c in x:
-            if c in String.char_to_escape:
-                s += '\\%s' % String.char_to_escape[c]
-            else:
-                s += c
-        s += '"'
-        f.write(s)
+        f.write('"%s"' % unescaped_re.sub(escape_char, str(x)))
     elif isinstance(x, Environment):
         while x is not None:
             f.write(str(x))
             x = x.parent
     elif isinstance(x, Pair):
         f.write('(')
-        write_pair(f, x)
+        write_pair(f, x, display)
+        f.write(')')
+    elif isinstance(x, F64Vector):
+        f.write('#f64(%s)' % ' '.join(map(format_number, x.items)))
+    elif isinstance(x, Vector):
+        f.write('#(')
+        for i, item in enumerate(x):
+            if i:
+                f.write(' ')
+            write(f, item, display)
         f.write(')')
-    elif isinstance(x, type(lambda: None)):
+    elif isinstance(x, Procedure):
         f.write('#<procedure>')
+    elif isinstance(x, Macro):
+        f.write('#<syntax>')
+    elif isinstance(x, HashTable):
+        f.write('#<hash-table>')
     elif x is None:
         f.write('()')
-    elif isinstance(x, file):
+    elif isinstance(x, (InputPort, OutputPort)):
         f.write('#<port>')
     elif x is EOF:
         f.write('#<eof-object>')
     else:
         exit("can't write unknown type")
 
+global_env = Environment(None)
+global_env.populate()
+
 def main():
-    while True:
-        sys.stdout.write('> ')
-        exp = read(sys.stdin)
-        if exp is EOF:
-            print
-            break
-        write(sys.stdout, scheval(exp, global_env))
-        print
+    global use_bytecode, weak_symbols
+    profile_file = None
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg == '--bytecode':
+            use_bytecode = True
+        elif arg == '--image' and args:
+            load_image(args.pop(0))
+        elif arg == '--profile' and args:
+            profile_file = args.pop(0)
+        elif arg == '--weak-symbols':
+            weak_symbols = True
+        else:
+            exit('usage: %s [--bytecode] [--image FILE] [--profile FILE] '
+                 '[--weak-symbols]' % sys.argv[0])
+    if profile_file:
+        start_profiling()
+    try:
+        while True:
+            stdout_port.write('> ')
+            if stdin_port.interactive:
+                stdout_port.flush()
+            exp = read(stdin_port)
+            if exp is EOF:
+                stdout_port.write('\n')
+                break
+            write(stdout_port, scheval(exp, global_env))
+            stdout_port.write('\n')
+            stdout_port.written(True)
+    finally:
+        flush_file_ports()
+        if profile_file:
+            stop_profiling(profile_file)
 
 if __name__ == '__main__':
     main()